@@ -0,0 +1,188 @@
+# !/usr/bin/env python3
+
+# Local stand-in for the Geneea generator endpoint, used for offline benchmarking of the realizer.
+# Accepts the same payload as Realizer.create_geneea_input and returns {"article": ...}
+
+# libraries
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+
+# handling arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", default="127.0.0.1", type=str, help="Host to listen on")
+parser.add_argument("--port", default=8080, type=int, help="Port to listen on")
+parser.add_argument("--latency", default="fixed", choices=["fixed", "uniform", "lognormal"],
+                    help="Distribution of the response latency")
+parser.add_argument("--latency_ms", default=200.0, type=float, help="Mean (fixed/lognormal) or maximum (uniform) "
+                                                                    "latency in milliseconds")
+parser.add_argument("--latency_sigma", default=0.5, type=float, help="Sigma of the lognormal latency")
+parser.add_argument("--error_rate", default=0.0, type=float, help="Probability of answering 500")
+parser.add_argument("--throttle_rate", default=0.0, type=float, help="Requests per second served before answering "
+                                                                     "429, 0 turns throttling off")
+parser.add_argument("--throttle_burst", default=5, type=int, help="Requests allowed in a burst")
+parser.add_argument("--retry_after", default=1, type=int, help="Retry-After seconds sent with 429")
+parser.add_argument("--seed", default=None, type=int, help="Seed of latency and error draws")
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Naive inflection
+
+class NaiveMorph:
+    DIRECTIVE = re.compile(r"\{\{'(.*?)'\|morph\((.*?)\)\}\}")
+
+    # (word ending, replacement), first matching rule is used
+    CASE_ENDINGS = {
+        'Acc': [('á', 'ou'), ('a', 'u')],
+        'Dat': [('á', 'é'), ('a', 'e')],
+        'Loc': [('á', 'é'), ('a', 'e')],
+        'Ins': [('á', 'ou'), ('a', 'ou')],
+        'Gen': [('á', 'é'), ('a', 'y')],
+    }
+    PAST_ENDINGS = {
+        'Sing': [('ít', 'il'), ('át', 'al'), ('at', 'al'), ('it', 'il'), ('et', 'el'), ('t', 'l')],
+        'Plur': [('ít', 'ili'), ('át', 'ali'), ('at', 'ali'), ('it', 'ili'), ('et', 'eli'), ('t', 'li')],
+    }
+
+    @staticmethod
+    def render(template: str) -> str:
+        return NaiveMorph.DIRECTIVE.sub(lambda d: NaiveMorph.inflect(d.group(1), d.group(2)), template)
+
+    @staticmethod
+    def inflect(lemma: str, params: str) -> str:
+        case = re.search(r"Case=(\w+)", params)
+        tense = re.search(r"Tense=(\w+)", params)
+        number = re.search(r"Number=(\w+)", params)
+
+        if tense is not None and tense.group(1) == 'Past':
+            return NaiveMorph._replace_ending(lemma, NaiveMorph.PAST_ENDINGS[number.group(1) if number else 'Sing'])
+        if case is not None and case.group(1) in NaiveMorph.CASE_ENDINGS:
+            # adjectives and nouns of the phrase get the same ending
+            rules = NaiveMorph.CASE_ENDINGS[case.group(1)]
+            return ' '.join(NaiveMorph._replace_ending(word, rules) for word in lemma.split(' '))
+        return lemma
+
+    @staticmethod
+    def _replace_ending(word: str, rules: List[Tuple[str, str]]) -> str:
+        for (ending, replacement) in rules:
+            if word.endswith(ending):
+                return word[:-len(ending)] + replacement
+        return word
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Server behaviour
+
+class StubBehaviour:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.tokens = float(args.throttle_burst)
+        self.updated = time.monotonic()
+        self.served = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def draw_latency(self) -> float:
+        mean = self.args.latency_ms / 1000
+        with self.lock:
+            if self.args.latency == 'uniform':
+                return self.rng.uniform(0, mean)
+            elif self.args.latency == 'lognormal':
+                sigma = self.args.latency_sigma
+                # mu chosen so the distribution has the requested mean
+                return self.rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean > 0 else 0.0
+            return mean
+
+    def count_served(self):
+        with self.lock:
+            self.served += 1
+
+    def draw_error(self) -> bool:
+        with self.lock:
+            failed = self.rng.random() < self.args.error_rate
+            self.failed += failed
+            return failed
+
+    def take_token(self) -> bool:
+        if self.args.throttle_rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.args.throttle_burst, self.tokens + (now - self.updated) * self.args.throttle_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.throttled += 1
+            return False
+
+
+def create_handler(behaviour: StubBehaviour):
+    class GeneeaStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip('/') != '/generate':
+                self._send(404, {'error': 'unknown endpoint'})
+                return
+
+            if not behaviour.take_token():
+                self._send(429, {'error': 'too many requests'}, {'Retry-After': str(behaviour.args.retry_after)})
+                return
+
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                bodies = [t['body'] for t in payload['templates']]
+            except (ValueError, KeyError, TypeError):
+                self._send(400, {'error': 'invalid payload'})
+                return
+
+            time.sleep(behaviour.draw_latency())
+            if behaviour.draw_error():
+                self._send(500, {'error': 'internal error'})
+                return
+
+            behaviour.count_served()
+            self._send(200, {'article': '\n'.join(NaiveMorph.render(body) for body in bodies)})
+
+        def _send(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return GeneeaStubHandler
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# MAIN
+def main(args):
+    behaviour = StubBehaviour(args)
+    server = ThreadingHTTPServer((args.host, args.port), create_handler(behaviour))
+    print(f"Geneea stand-in listening on http://{args.host}:{args.port}/generate")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"served: {behaviour.served}, throttled: {behaviour.throttled}, failed: {behaviour.failed}")
+
+
+if __name__ == "__main__":
+    args_ = parser.parse_args()
+    main(args_)
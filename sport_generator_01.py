@@ -2,22 +2,95 @@
 
 # libraries
 import argparse
+import array
+import ast
+import bisect
+import gzip
+import hashlib
+import heapq
+import inspect
 import json
+import mmap
+import zlib
 #from random import Random
 import random
 import os
+import pickle
+import queue
+import re
 import requests
+import sqlite3
+import struct
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 from enum import Enum
-from typing import List, Tuple, Dict, Union
+from typing import List, Tuple, Dict, Union, Iterator, Callable
 from string import Template as Tmpl
 from dataclasses import dataclass
+from collections import deque
 from copy import deepcopy
 
+try:
+    import numpy
+except ImportError:  # optional, batch lexicalization falls back to random.Random
+    numpy = None
+
 
 # handling arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("--match_data", default="0Ao9H20P.json", type=str, help="JSON file with match data")
 parser.add_argument("--test", default=False, type=bool, help="Testing for errors in each match")
+parser.add_argument("--quarantine", default=None, type=str, help="Directory where invalid match feeds are moved "
+                                                                  "while testing")
+parser.add_argument("--geneea_url", default="https://generator.geneea.com/generate", type=str,
+                    help="Geneea generator endpoint, e.g. a local geneea_stub_server.py")
+parser.add_argument("--geneea_rate", default=5.0, type=float, help="Sustained rate of Geneea requests per second")
+parser.add_argument("--geneea_burst", default=5, type=int, help="Number of Geneea requests allowed in a burst")
+parser.add_argument("--geneea_retries", default=5, type=int, help="Retries of failed Geneea requests")
+parser.add_argument("--deadline", default=None, type=float, help="Seconds the realizer has for one article before "
+                                                                 "a degraded local realization is used")
+parser.add_argument("--hedge_percentile", default=95.0, type=float, help="Percentile of realizer latency after "
+                                                                         "which a duplicate request is sent")
+parser.add_argument("--replay", default=None, type=str, help="Regenerates --match_data with the wording traced in "
+                                                              "this SQLite output")
+parser.add_argument("--rerealize", default=None, type=str, help="Re-realizes degraded articles of SQLite output")
+parser.add_argument("--batch", default=None, type=str, help="Directory with match data to generate articles for")
+parser.add_argument("--output_jsonl", default=None, type=str, help="JSONL file the generated articles are appended to")
+parser.add_argument("--output_sqlite", default=None, type=str, help="SQLite database the generated articles are "
+                                                                     "stored in")
+parser.add_argument("--sink_batch_size", default=500, type=int, help="Number of articles written in one transaction")
+parser.add_argument("--max_sentences", default=None, type=int, help="Maximal number of sentences in article body")
+parser.add_argument("--max_chars", default=None, type=int, help="Maximal estimated number of characters in article "
+                                                                 "body")
+parser.add_argument("--explain_selection", action='store_true', help="Print why messages were selected or dropped")
+parser.add_argument("--variants", default=1, type=int, help="Number of distinct article variants per match")
+parser.add_argument("--inflection_memo", default=None, type=str, help="JSON file with memoized inflected forms")
+parser.add_argument("--cache_dir", default=None, type=str, help="Directory of the stage artifact cache")
+parser.add_argument("--cache_max_mb", default=512, type=int, help="Maximal size of the stage artifact cache in MB")
+parser.add_argument("--cache_info", action='store_true', help="Print content of the stage artifact cache")
+parser.add_argument("--cache_clear", action='store_true', help="Remove everything from the stage artifact cache")
+parser.add_argument("--corpus", default=None, type=str, help="Packed corpus the match data are read from, "
+                                                              "--match_data is then a match id")
+parser.add_argument("--pack_corpus", default=None, type=str, help="Pack all match data in the directory into --corpus")
+parser.add_argument("--manifest", default=None, type=str, help="Manifest recording the state of every match of a batch")
+parser.add_argument("--resume", action='store_true', help="Skip matches the manifest records as done")
+parser.add_argument("--shard", default="0/1", type=str, help="Part i/N of the batch processed by this run")
+parser.add_argument("--speculate", default=None, type=int, help="Simulates live generation: realizes the match known "
+                                                                 "at this minute in advance, then finalizes it")
+parser.add_argument("--lexicalize_round", action='store_true', help="Only lexicalizes all matches of --batch "
+                                                                    "together, without realization")
+parser.add_argument("--round_digest", action='store_true', help="Generates one digest per tournament from all "
+                                                                "matches of --batch")
+parser.add_argument("--workers", default=1, type=int, help="Number of threads generating articles of a batch")
+parser.add_argument("--export_store", default=None, type=str, help="Export incidents of all matches into a columnar "
+                                                                    "store at the given path")
+parser.add_argument("--sink_flush_interval", default=5.0, type=float, help="Seconds after which buffered articles "
+                                                                           "are written")
 
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -56,6 +129,15 @@ class Types:
         CARD = 2
         SUBSTITUTION = 3
         RESULT = 4
+        SUBSTITUTIONS = 5
+        CARDS = 6
+        SECOND_YELLOW = 7
+        SCORER = 8
+
+    class Priority(Enum):
+        LIVE = 0
+        JUST_FINISHED = 1
+        BACKLOG = 2
 
     class MessageSubtype(Enum):
         WIN = 0
@@ -84,6 +166,10 @@ class Types:
             Pres = 1
             Fut = 2
 
+        class Number(Enum):
+            Sing = 0
+            Plur = 1
+
     class Constituent(Enum):
         ENTITY = 0
         VERB = 1
@@ -281,10 +367,16 @@ class MatchData:
     score: Score
     venue: Venue
     incidents: List[Incidents]
+    match_id: str
+    tournament_name: str
+    timeline: 'MatchTimeline'
 
     @staticmethod
-    def create(team_home: Team, team_away: Team, score: Score, venue: Venue, incidents: List[Incidents]):
-        return MatchData(team_home=team_home, team_away=team_away, score=score, venue=venue, incidents=incidents)
+    def create(team_home: Team, team_away: Team, score: Score, venue: Venue, incidents: List[Incidents],
+               match_id: str, tournament_name: str = None):
+        timeline = MatchTimeline.create(team_home=team_home, team_away=team_away, incidents=incidents)
+        return MatchData(team_home=team_home, team_away=team_away, score=score, venue=venue, incidents=incidents,
+                         match_id=match_id, tournament_name=tournament_name, timeline=timeline)
 
     def __str__(self):
         return f"MATCH DATA SUMMARY \n\t{self.team_home}\n\t{self.team_away}\n\t{self.score}\n\t{self.venue}\n" \
@@ -296,18 +388,33 @@ class MatchData:
 # class handing conversion from JSON to MatchData class
 class DataInitializer:
     @staticmethod
-    def init_match_data(json_file_str: str) -> MatchData:
+    def init_match_data(json_file_str: str, validate: bool = True) -> MatchData:
+        json_match_data = load_feed(json_file_str)
+
+        return DataInitializer.init_match_data_from_json(json_match_data, validate=validate)
+
+    @staticmethod
+    def init_match_data_from_json(json_match_data: dict, validate: bool = True) -> MatchData:
         initializer = DataInitializer()
 
-        with open(json_file_str) as json_file:
-            json_match_data = json.load(json_file)
+        if validate:
+            DataValidator.check(json_match_data)
 
         teams: List[Team] = initializer._init_teams(json_match_data=json_match_data)
         venue: Venue = initializer._init_venue(json_match_data=json_match_data)
         score: Score = initializer._init_score(json_match_data=json_match_data)
         incidents: List[Incidents] = initializer._init_incidents(json_match_data=json_match_data)
+        match_id: str = initializer._init_match_id(json_match_data=json_match_data)
+        tournament_name: str = json_match_data.get('tournament_name')
+
+        return MatchData.create(team_home=teams[0], team_away=teams[1], venue=venue, score=score,
+                                incidents=incidents, match_id=match_id, tournament_name=tournament_name)
 
-        return MatchData(team_home=teams[0], team_away=teams[1], venue=venue, score=score, incidents=incidents)
+    @staticmethod
+    def _init_match_id(json_match_data: dict) -> str:
+        # livesport url ends with the match id, e.g. https://www.livesport.cz/zapas/0Ao9H20P
+        url = json_match_data.get('url')
+        return url.rstrip('/').split('/')[-1] if url else None
 
     @staticmethod
     def _init_teams(json_match_data: dict) -> List[Team]:
@@ -476,9 +583,322 @@ class DataInitializer:
                 raise ValueError("Unknown incident occurred")
 
         # sort incidents by time
+        incidents.sort()
 
         return incidents
 
+# --------------------------------------------------------------------------------------------------------------------
+# Match timeline
+#   state of the match after every incident, queries bisect into the sorted times
+#   (state at time t includes incidents which happened at t)
+
+class MatchTimeline:
+    FULL_TEAM = 11
+
+    def __init__(self, team_home: Team, team_away: Team, incidents: List[Incidents]):
+        teams = {team_home.id: team_home, team_away.id: team_away}
+
+        self._score_times: List[Time] = []
+        self._scores: List[Score] = []
+
+        # per team: times of lineup changes and players on the pitch after each change
+        self._lineup_times: Dict[Types.Team, List[Time]] = {}
+        self._lineups: Dict[Types.Team, List[frozenset]] = {}
+        # per team: times of cards and cumulative (yellow, red) counts
+        self._card_times: Dict[Types.Team, List[Time]] = {}
+        self._cards: Dict[Types.Team, List[Tuple[int, int]]] = {}
+        # per team: times of sending-offs of players on the pitch, the count is the position in the list
+        self._sent_off_times: Dict[Types.Team, List[Time]] = {}
+
+        self._players: Dict[int, Player] = {}
+        for team in teams.values():
+            starters = frozenset(p.id for p in team.lineup if p.lineup_position_id == 1)
+            self._lineup_times[team.type] = [Time.create(0, 0)]
+            self._lineups[team.type] = [starters]
+            self._card_times[team.type] = []
+            self._cards[team.type] = []
+            self._sent_off_times[team.type] = []
+            self._players.update((p.id, p) for p in team.lineup)
+
+        goals = {Types.Team.HOME: 0, Types.Team.AWAY: 0}
+        for inc in incidents:
+            team_type = inc.team.type
+            if inc.type == Types.Incident.GOAL or (inc.type == Types.Incident.PENALTY_KICK and inc.scored):
+                if inc.type == Types.Incident.GOAL and inc.goal_type == Types.Goal.OWN_GOAL:
+                    team_type = Types.Team.AWAY if team_type == Types.Team.HOME else Types.Team.HOME
+                goals[team_type] += 1
+                self._score_times.append(inc.time)
+                self._scores.append(Score.create(goals[Types.Team.HOME], goals[Types.Team.AWAY]))
+
+            elif inc.type == Types.Incident.SUBSTITUTION:
+                on_pitch = self._lineups[team_type][-1] - {inc.participant.id}
+                if inc.participant_in is not None:
+                    on_pitch |= {inc.participant_in.id}
+                self._add_lineup(team_type, inc.time, on_pitch)
+
+            elif inc.type == Types.Incident.CARD:
+                (yellow, red) = self._cards[team_type][-1] if self._cards[team_type] else (0, 0)
+                if inc.card_type == Types.Card.YELLOW:
+                    yellow += 1
+                else:
+                    red += 1
+                    # red cards of coaches and substitutes on the bench don't leave the team short-handed
+                    on_pitch = self._lineups[team_type][-1]
+                    if inc.participant.id in on_pitch:
+                        self._add_lineup(team_type, inc.time, on_pitch - {inc.participant.id})
+                        self._sent_off_times[team_type].append(inc.time)
+                self._card_times[team_type].append(inc.time)
+                self._cards[team_type].append((yellow, red))
+
+    @staticmethod
+    def create(team_home: Team, team_away: Team, incidents: List[Incidents]):
+        return MatchTimeline(team_home=team_home, team_away=team_away, incidents=incidents)
+
+    def _add_lineup(self, team_type: Types.Team, time: Time, on_pitch: frozenset):
+        self._lineup_times[team_type].append(time)
+        self._lineups[team_type].append(frozenset(on_pitch))
+
+    @staticmethod
+    def _index(times: List[Time], time: Time, inclusive: bool) -> int:
+        # index of the last state valid at time, -1 before the first one
+        return (bisect.bisect_right(times, time) if inclusive else bisect.bisect_left(times, time)) - 1
+
+    def score_at(self, time: Time, inclusive: bool = True) -> Score:
+        k = MatchTimeline._index(self._score_times, time, inclusive)
+        return self._scores[k] if k >= 0 else Score.create(0, 0)
+
+    def player_ids_on_pitch(self, team_type: Types.Team, time: Time, inclusive: bool = True) -> frozenset:
+        k = MatchTimeline._index(self._lineup_times[team_type], time, inclusive)
+        return self._lineups[team_type][max(k, 0)]
+
+    def players_on_pitch(self, team_type: Types.Team, time: Time, inclusive: bool = True) -> List[Player]:
+        return [self._players[p] for p in self.player_ids_on_pitch(team_type, time, inclusive) if p in self._players]
+
+    def is_on_pitch(self, player: Player, team_type: Types.Team, time: Time, inclusive: bool = True) -> bool:
+        return player.id in self.player_ids_on_pitch(team_type, time, inclusive)
+
+    def is_short_handed(self, team_type: Types.Team, time: Time) -> bool:
+        return self.sent_off_at(team_type, time) > 0
+
+    def players_count(self, team_type: Types.Team, time: Time) -> int:
+        return MatchTimeline.FULL_TEAM - self.sent_off_at(team_type, time)
+
+    def sent_off_at(self, team_type: Types.Team, time: Time) -> int:
+        return MatchTimeline._index(self._sent_off_times[team_type], time, True) + 1
+
+    def cards_at(self, team_type: Types.Team, time: Time) -> Tuple[int, int]:
+        k = MatchTimeline._index(self._card_times[team_type], time, True)
+        return self._cards[team_type][k] if k >= 0 else (0, 0)
+
+    def final_score(self) -> Score:
+        return self._scores[-1] if self._scores else Score.create(0, 0)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Data Validation
+
+# class checking the structure of JSON match data before DataInitializer parses it
+class DataValidator:
+    # incident types handled by DataInitializer._init_incidents
+    MAIN_INCIDENTS = {"Goal", "Own Goal", "Penalty Kick", "Substitution - Out", "Yellow Card", "Red Card"}
+    AUX_INCIDENTS = {"Substitution - In", "Assistance", "Penalty scored", "Penalty missed",
+                     "Extended time second half", "Extended time first half", "Action not on pitch",
+                     "Goal Disallowed"}
+
+    @staticmethod
+    def check(json_match_data: dict):
+        problems = DataValidator.validate(json_match_data)
+        if problems:
+            raise ValueError("Invalid match data: " + "; ".join(problems))
+
+    @staticmethod
+    def is_valid(json_match_data: dict) -> bool:
+        return not DataValidator.validate(json_match_data)
+
+    @staticmethod
+    def validate(json_match_data: dict) -> List[str]:
+        problems: List[str] = []
+
+        if not isinstance(json_match_data, dict):
+            return ["match data is not a JSON object"]
+
+        team_ids: List[int] = DataValidator._validate_participants(json_match_data, problems)
+        lineup_ids: Dict[int, set] = DataValidator._validate_lineups(json_match_data, team_ids, problems)
+        DataValidator._validate_score(json_match_data, problems)
+        DataValidator._validate_venue(json_match_data, problems)
+
+        # stop before incidents, they rely on teams and lineups
+        if problems:
+            return problems
+
+        DataValidator._validate_incidents(json_match_data, lineup_ids, problems)
+        return problems
+
+    # consistency of parsed incidents with the state of the match
+    @staticmethod
+    def validate_match_data(match_data: MatchData) -> List[str]:
+        problems: List[str] = []
+        timeline: MatchTimeline = match_data.timeline
+
+        for inc in match_data.incidents:
+            if inc.type != Types.Incident.SUBSTITUTION:
+                continue
+            if not timeline.is_on_pitch(inc.participant, inc.team.type, inc.time, inclusive=False):
+                problems.append(f"{inc.participant.full_name} substituted at {inc.time} was not on the pitch")
+            if inc.participant_in is not None \
+                    and timeline.is_on_pitch(inc.participant_in, inc.team.type, inc.time, inclusive=False):
+                problems.append(f"{inc.participant_in.full_name} coming on at {inc.time} was already on the pitch")
+
+        final_score = timeline.final_score()
+        if (final_score.goals_home, final_score.goals_away) != (match_data.score.goals_home,
+                                                                match_data.score.goals_away):
+            problems.append(f"goals sum up to {final_score}, final score is {match_data.score}")
+
+        return problems
+
+    @staticmethod
+    def _validate_participants(json_match_data: dict, problems: List[str]) -> List[int]:
+        team_ids: List[int] = []
+        participants = json_match_data.get('participants')
+        for team_type in Types.Team:
+            team = participants.get(str(team_type.value)) if isinstance(participants, dict) else None
+            if not isinstance(team, dict):
+                problems.append(f"missing participant of team {team_type.name}")
+                continue
+            for key in ('id', 'name', 'country_id', 'country_name'):
+                if team.get(key) is None:
+                    problems.append(f"participant of team {team_type.name} has no '{key}'")
+            if DataValidator._is_int(team.get('id')):
+                team_ids.append(int(team['id']))
+        return team_ids
+
+    @staticmethod
+    def _validate_lineups(json_match_data: dict, team_ids: List[int], problems: List[str]) -> Dict[int, set]:
+        lineup_ids: Dict[int, set] = {}
+        lineups = json_match_data.get('lineup')
+        for team_type in Types.Team:
+            lineup = lineups.get(str(team_type.value)) if isinstance(lineups, dict) else None
+            if not lineup:
+                problems.append(f"missing lineup of team {team_type.name}")
+                continue
+
+            ids = set()
+            for p in lineup:
+                try:
+                    ids.add(int(p['participant']['id']))
+                    country = p['participant']['countries'][0]
+                    if p['participant']['fullName'] is None or country['id'] is None or country['name'] is None:
+                        raise ValueError
+                    int(p['lineupPositionId'])
+                    int(p['number'])
+                except (KeyError, IndexError, TypeError, ValueError):
+                    problems.append(f"malformed lineup entry of team {team_type.name}")
+                    break
+
+            if len(team_ids) == len(Types.Team):
+                lineup_ids[team_ids[team_type.value]] = ids
+        return lineup_ids
+
+    @staticmethod
+    def _validate_score(json_match_data: dict, problems: List[str]):
+        try:
+            for team_type in Types.Team:
+                int(json_match_data['score'][str(team_type.value)]['1'])
+        except (KeyError, TypeError, ValueError):
+            problems.append("missing final score")
+
+    @staticmethod
+    def _validate_venue(json_match_data: dict, problems: List[str]):
+        for key in ('venue_name', 'venue_town', 'venue_attendance'):
+            if key not in json_match_data:
+                problems.append(f"missing '{key}'")
+        capacity = json_match_data.get('venue_capacity')
+        if not DataValidator._is_int(capacity) or int(capacity) <= 0:
+            problems.append("missing or zero 'venue_capacity'")
+
+    @staticmethod
+    def _validate_incidents(json_match_data: dict, lineup_ids: Dict[int, set], problems: List[str]):
+        incidents = json_match_data.get('incidents')
+        if not isinstance(incidents, list):
+            problems.append("missing incidents")
+            return
+
+        # children of each incident, DataInitializer looks them up by parentId
+        children: Dict[int, List[dict]] = {}
+        for i in incidents:
+            try:
+                if i['parentId'] is not None:
+                    children.setdefault(int(i['parentId']), []).append(i)
+            except (KeyError, TypeError, ValueError):
+                problems.append("incident with malformed 'parentId'")
+                return
+
+        for i in incidents:
+            try:
+                DataValidator._validate_incident(i, children, lineup_ids, problems)
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+                problems.append(f"malformed incident {i.get('id') if isinstance(i, dict) else i}")
+
+    @staticmethod
+    def _validate_incident(i: dict, children: Dict[int, List[dict]], lineup_ids: Dict[int, set],
+                           problems: List[str]):
+        inc_id = int(i['id'])
+        inc_str_type = i['type']['name']
+        int(i['time'])
+        if i['addedTime'] is not None:
+            int(i['addedTime'])
+
+        if inc_str_type in DataValidator.AUX_INCIDENTS:
+            return
+        if inc_str_type not in DataValidator.MAIN_INCIDENTS:
+            problems.append(f"incident {inc_id} has unknown type '{inc_str_type}'")
+            return
+        if i['participant']['id'] is None:
+            problems.append(f"incident {inc_id} ({inc_str_type}) has no participant")
+            return
+
+        event_participants = i['eventParticipant']['participant']
+        if not event_participants or int(event_participants[0]['id']) not in lineup_ids:
+            problems.append(f"incident {inc_id} ({inc_str_type}) does not belong to any team")
+            return
+
+        team_id = int(event_participants[0]['id'])
+        if inc_str_type == "Own Goal":
+            team_id = [t for t in lineup_ids if t != team_id][0]
+        lineup = lineup_ids[team_id]
+        participant_id = int(i['participant']['id'])
+
+        if inc_str_type in ("Goal", "Own Goal", "Penalty Kick"):
+            if i['value'] is not None:
+                [home, away] = i['value'].split(":")
+                int(home), int(away)
+
+        if inc_str_type in ("Yellow Card", "Red Card"):
+            # cards for coaches are allowed
+            return
+        if participant_id not in lineup:
+            problems.append(f"incident {inc_id} ({inc_str_type}) has participant outside of the lineup")
+
+        aux_incidents = children.get(inc_id, [])
+        if inc_str_type == "Substitution - Out":
+            if not aux_incidents:
+                problems.append(f"incident {inc_id} (Substitution - Out) has no Substitution - In")
+            elif aux_incidents[0]['participant']['id'] not in lineup:
+                problems.append(f"incident {inc_id} (Substitution - Out) has substitute outside of the lineup")
+        elif inc_str_type == "Goal" and aux_incidents:
+            if aux_incidents[0]['participant']['id'] is None \
+                    or int(aux_incidents[0]['participant']['id']) not in lineup:
+                problems.append(f"incident {inc_id} (Goal) has assistance outside of the lineup")
+
+    @staticmethod
+    def _is_int(value) -> bool:
+        try:
+            int(value)
+            return True
+        except (TypeError, ValueError):
+            return False
+
+
 # --------------------------------------------------------------------------------------------------------------------
 # Document planning
 
@@ -570,29 +990,156 @@ class Messages:
             return f"-> Type: {self.type.name}, time: {self.time}, participant: " \
                 f"{self.participant.full_name}, team: {self.team.name}"
 
+    @dataclass(frozen=True)
+    class Substitutions(Message):
+        participants: List[Tuple[Player, Player]]  # (out, in)
+        team: Team
+        time: Time
+
+        @staticmethod
+        def create(participants: List[Tuple[Player, Player]], team: Team, time: Time):
+            return Messages.Substitutions(type=Types.Message.SUBSTITUTIONS, participants=participants,
+                                          team=team, time=time)
+
+        def __str__(self):
+            return f"-> Type: {self.type.name}, time: {self.time}, participants: " + \
+                ", ".join(f"{p_in.full_name} for {p_out.full_name}" for (p_out, p_in) in self.participants) + \
+                f", team: {self.team.name}"
+
+    @dataclass(frozen=True)
+    class Cards(Message):
+        participants: List[Player]
+        team: Team
+        time: Time
+        card_type: Types.Card
+
+        @staticmethod
+        def create(participants: List[Player], team: Team, time: Time, card_type: Types.Card):
+            return Messages.Cards(type=Types.Message.CARDS, participants=participants, team=team, time=time,
+                                  card_type=card_type)
+
+        def __str__(self):
+            return f"-> Type: {self.type.name}, time: {self.time}, participants: " \
+                f"{', '.join(p.full_name for p in self.participants)}, team: {self.team.name}, " \
+                f"card_type: {self.card_type.name}"
+
+    @dataclass(frozen=True)
+    class SecondYellow(Message):
+        participant: Player
+        team: Team
+        time: Time
+        first_time: Time
+
+        @staticmethod
+        def create(participant: Player, team: Team, time: Time, first_time: Time):
+            return Messages.SecondYellow(type=Types.Message.SECOND_YELLOW, participant=participant, team=team,
+                                         time=time, first_time=first_time)
+
+        def __str__(self):
+            return f"-> Type: {self.type.name}, time: {self.time}, first_time: {self.first_time}, " \
+                f"participant: {self.participant.full_name}, team: {self.team.name}"
+
+    # player with several goals in one match, used by round digests
+    @dataclass(frozen=True)
+    class Scorer(Message):
+        participant: Player
+        team: Team
+        opponent: Team
+        goals: int
+
+        @staticmethod
+        def create(participant: Player, team: Team, opponent: Team, goals: int):
+            return Messages.Scorer(type=Types.Message.SCORER, participant=participant, team=team, opponent=opponent,
+                                   goals=goals)
+
+        def __str__(self):
+            return f"-> Type: {self.type.name}, goals: {self.goals}, participant: {self.participant.full_name}, " \
+                f"team: {self.team.name}, opponent: {self.opponent.name}"
+
+
+@dataclass(frozen=True)
+class ContentBudget:
+    max_sentences: int
+    max_chars: int
+
+    @staticmethod
+    def create(max_sentences: int = None, max_chars: int = None):
+        return ContentBudget(max_sentences=max_sentences, max_chars=max_chars)
+
+    def is_unlimited(self) -> bool:
+        return self.max_sentences is None and self.max_chars is None
+
+
+@dataclass(frozen=True)
+class SelectionEntry:
+    message: Message
+    importance: float
+    estimated_length: int
+    selected: bool
+
+    def __str__(self):
+        return f"{'+' if self.selected else '-'} importance: {self.importance}, " \
+            f"length: {self.estimated_length} {self.message}"
+
 
 @dataclass(frozen=True)
 class DocumentPlan:
     title: Messages
     body: List[Messages]
+    selection: List[SelectionEntry]
+    # positions in MatchData.incidents every body message was made from
+    sources: List[Tuple[int, ...]]
 
     @staticmethod
-    def create(title: Messages, body: List[Messages]):
-        return DocumentPlan(title=title, body=body)
+    def create(title: Messages, body: List[Messages], selection: List[SelectionEntry] = None,
+               sources: List[Tuple[int, ...]] = None):
+        return DocumentPlan(title=title, body=body, selection=selection if selection is not None else [],
+                            sources=sources if sources is not None else [])
+
+    def explain_selection(self) -> str:
+        return "CONTENT SELECTION\n\t" + "\n\t".join(map(str, self.selection))
 
     def __str__(self):
         return f"TITLE MESSAGE: \n\t{self.title}\nMESSAGES\n\t" + "\n\t".join(map(str, self.body))
 
 
 class DocumentPlanner:
+    budget: ContentBudget = ContentBudget.create()
+    # debug dump of the content selection of every planned match
+    explain: bool = False
+
+    # importance of body messages, goals and red cards outrank routine substitutions
+    IMPORTANCE_GOAL = 10.0
+    IMPORTANCE_RED_CARD = 8.0
+    IMPORTANCE_MISSED_PENALTY = 6.0
+    IMPORTANCE_YELLOW_CARD = 3.0
+    IMPORTANCE_SUBSTITUTION = 1.0
+    # goal changing who leads the match (equalizer, taking the lead)
+    IMPORTANCE_DECISIVE_GOAL = 2.0
+
+    # average length of realized sentence, the text isn't known before lexicalization
+    ESTIMATED_LENGTH = {
+        Types.Message.GOAL: 75,
+        Types.Message.PENALTY_KICK_MISSED: 50,
+        Types.Message.CARD: 55,
+        Types.Message.SUBSTITUTION: 60,
+    }
+
+    @staticmethod
+    def configure(budget: ContentBudget, explain: bool = False):
+        DocumentPlanner.budget = budget
+        DocumentPlanner.explain = explain
 
     @staticmethod
-    def plan_document(match_data: MatchData) -> DocumentPlan:
+    def plan_document(match_data: MatchData, budget: ContentBudget = None) -> DocumentPlan:
         doc_planner = DocumentPlanner()
         title: Messages = doc_planner._plan_title(match_data)
         body: List[Messages] = doc_planner._plan_body(match_data)
+        (body, selection) = doc_planner._select_content(body, match_data.timeline,
+                                                        budget if budget is not None else DocumentPlanner.budget)
+        sources = [(k,) for k, entry in enumerate(selection) if entry.selected]
 
-        return DocumentPlan.create(title, body)
+        return DocumentPlan.create(title, body, selection, sources)
 
     @staticmethod
     def _plan_title(match_data: MatchData) -> Messages:
@@ -624,6 +1171,194 @@ class DocumentPlanner:
     def _plan_body(match_data: MatchData) -> List[Messages]:
         return [DocumentPlanner._plan_incident_msg(inc) for inc in match_data.incidents]
 
+    @staticmethod
+    def _get_importance(msg: Messages, timeline: MatchTimeline) -> float:
+        if msg.type == Types.Message.GOAL:
+            before = timeline.score_at(msg.time, inclusive=False).result
+            after = timeline.score_at(msg.time).result
+            return DocumentPlanner.IMPORTANCE_GOAL + (DocumentPlanner.IMPORTANCE_DECISIVE_GOAL if before != after
+                                                      else 0.0)
+        elif msg.type == Types.Message.CARD:
+            if msg.card_type == Types.Card.YELLOW:
+                return DocumentPlanner.IMPORTANCE_YELLOW_CARD
+            return DocumentPlanner.IMPORTANCE_RED_CARD
+        elif msg.type == Types.Message.PENALTY_KICK_MISSED:
+            return DocumentPlanner.IMPORTANCE_MISSED_PENALTY
+        else:
+            return DocumentPlanner.IMPORTANCE_SUBSTITUTION
+
+    @staticmethod
+    def _select_content(body: List[Messages], timeline: MatchTimeline,
+                        budget: ContentBudget) -> (List[Messages], List[SelectionEntry]):
+        importance = [DocumentPlanner._get_importance(msg, timeline) for msg in body]
+        lengths = [DocumentPlanner.ESTIMATED_LENGTH.get(msg.type, 60) for msg in body]
+
+        if budget.is_unlimited():
+            selected = set(range(len(body)))
+        else:
+            # most important first, earlier message wins a tie
+            queue = [(-importance[k], k) for k in range(len(body))]
+            heapq.heapify(queue)
+
+            selected = set()
+            chars = 0
+            while queue and (budget.max_sentences is None or len(selected) < budget.max_sentences):
+                (_, k) = heapq.heappop(queue)
+                if budget.max_chars is not None and chars + lengths[k] > budget.max_chars:
+                    continue
+                selected.add(k)
+                chars += lengths[k]
+
+        # chronological order is kept
+        selection = [SelectionEntry(message=msg, importance=importance[k], estimated_length=lengths[k],
+                                    selected=k in selected) for k, msg in enumerate(body)]
+        return [msg for k, msg in enumerate(body) if k in selected], selection
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Sentence aggregation
+#   - yellow card and RED_AUTO of the same player -> one sentence about the second yellow card
+#   - substitutions / yellow cards of one team in the same minute -> one sentence
+
+class Aggregator:
+
+    @staticmethod
+    def aggregate(doc_plan: DocumentPlan) -> DocumentPlan:
+        sources = doc_plan.sources or [() for _ in doc_plan.body]
+        (body, sources) = Aggregator._aggregate_second_yellow(doc_plan.body, sources)
+        (body, sources) = Aggregator._aggregate_same_time(body, sources)
+        return DocumentPlan.create(doc_plan.title, body, doc_plan.selection, sources)
+
+    @staticmethod
+    def _aggregate_second_yellow(body: List[Messages],
+                                 sources: List[Tuple[int, ...]]) -> (List[Messages], List[Tuple[int, ...]]):
+        first_yellow: Dict[int, int] = {}  # player id -> position of the yellow card
+        merged: Dict[int, Messages] = {}
+        merged_sources: Dict[int, Tuple[int, ...]] = {}
+        dropped = set()
+
+        for k, msg in enumerate(body):
+            if type(msg) is not Messages.Card:
+                continue
+            if msg.card_type == Types.Card.YELLOW:
+                first_yellow.setdefault(msg.participant.id, k)
+            elif msg.card_type == Types.Card.RED_AUTO and msg.participant.id in first_yellow:
+                yellow = first_yellow.pop(msg.participant.id)
+                dropped.add(yellow)
+                merged[k] = Messages.SecondYellow.create(participant=msg.participant, team=msg.team, time=msg.time,
+                                                         first_time=body[yellow].time)
+                merged_sources[k] = sources[yellow] + sources[k]
+
+        return ([merged.get(k, msg) for k, msg in enumerate(body) if k not in dropped],
+                [merged_sources.get(k, source) for k, source in enumerate(sources) if k not in dropped])
+
+    @staticmethod
+    def _aggregate_same_time(body: List[Messages],
+                             sources: List[Tuple[int, ...]]) -> (List[Messages], List[Tuple[int, ...]]):
+        # group key -> positions, group is placed where its first message was
+        groups: Dict[tuple, List[int]] = {}
+        for k, msg in enumerate(body):
+            key = Aggregator._get_group_key(msg)
+            if key is not None:
+                groups.setdefault(key, []).append(k)
+
+        merged: Dict[int, Messages] = {}
+        merged_sources: Dict[int, Tuple[int, ...]] = {}
+        dropped = set()
+        for positions in groups.values():
+            if len(positions) < 2:
+                continue
+            merged[positions[0]] = Aggregator._merge([body[k] for k in positions])
+            merged_sources[positions[0]] = sum((sources[k] for k in positions), ())
+            dropped.update(positions[1:])
+
+        return ([merged.get(k, msg) for k, msg in enumerate(body) if k not in dropped],
+                [merged_sources.get(k, source) for k, source in enumerate(sources) if k not in dropped])
+
+    @staticmethod
+    def _get_group_key(msg: Messages) -> tuple:
+        if type(msg) is Messages.Substitution:
+            return Types.Message.SUBSTITUTION, msg.team.id, msg.time
+        elif type(msg) is Messages.Card and msg.card_type == Types.Card.YELLOW:
+            return Types.Message.CARD, msg.team.id, msg.time
+        return None
+
+    @staticmethod
+    def _merge(msgs: List[Messages]) -> Messages:
+        first = msgs[0]
+        if type(first) is Messages.Substitution:
+            return Messages.Substitutions.create(participants=[(m.participant_out, m.participant_in) for m in msgs],
+                                                 team=first.team, time=first.time)
+        else:
+            return Messages.Cards.create(participants=[m.participant for m in msgs], team=first.team,
+                                         time=first.time, card_type=first.card_type)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Round digest planning
+
+@dataclass(frozen=True)
+class RoundPlan:
+    tournament_name: str
+    title: str
+    body: List[Messages]
+    # position of the match of every body message, players are referred to per match
+    matches: List[int]
+
+    @staticmethod
+    def create(tournament_name: str, title: str, body: List[Messages], matches: List[int]):
+        return RoundPlan(tournament_name=tournament_name, title=title, body=body, matches=matches)
+
+    def __str__(self):
+        return f"ROUND: {self.tournament_name}\nMESSAGES\n\t" + "\n\t".join(map(str, self.body))
+
+
+# one digest per tournament from all its matches of the round
+#   - every result, the most one-sided first
+#   - players with at least SCORER_MIN_GOALS goals in a match, at most MAX_SCORERS of them
+class RoundPlanner:
+    SCORER_MIN_GOALS = 2
+    MAX_SCORERS = 3
+
+    @staticmethod
+    def plan_rounds(match_data: List[MatchData]) -> List[RoundPlan]:
+        tournaments: Dict[str, List[int]] = {}
+        for k, data in enumerate(match_data):
+            tournaments.setdefault(data.tournament_name, []).append(k)
+        return [RoundPlanner.plan_round(name, match_data, positions) for name, positions in tournaments.items()]
+
+    @staticmethod
+    def plan_round(tournament_name: str, match_data: List[MatchData], positions: List[int]) -> RoundPlan:
+        results = sorted(positions, key=lambda k: (-match_data[k].score.goals_difference,
+                                                   -match_data[k].score.goals_sum))
+        body: List[Messages] = [DocumentPlanner._plan_title(match_data[k]) for k in results]
+        matches: List[int] = list(results)
+
+        scorers: List[Tuple[int, int, Player, Team]] = []
+        for k in positions:
+            for (player, team, goals) in RoundPlanner._get_scorers(match_data[k]):
+                if goals >= RoundPlanner.SCORER_MIN_GOALS:
+                    scorers.append((goals, k, player, team))
+        scorers.sort(key=lambda scorer: -scorer[0])
+
+        for (goals, k, player, team) in scorers[:RoundPlanner.MAX_SCORERS]:
+            opponent = match_data[k].team_away if team.type == Types.Team.HOME else match_data[k].team_home
+            body.append(Messages.Scorer.create(participant=player, team=team, opponent=opponent, goals=goals))
+            matches.append(k)
+
+        title = f"{tournament_name}: přehled kola." if tournament_name else "Přehled kola."
+        return RoundPlan.create(tournament_name, title, body, matches)
+
+    @staticmethod
+    def _get_scorers(match_data: MatchData) -> List[Tuple[Player, Team, int]]:
+        goals: Dict[int, list] = {}  # player id -> [player, team, goals]
+        for inc in match_data.incidents:
+            scored = (type(inc) is Incidents.Goal and inc.goal_type != Types.Goal.OWN_GOAL) or \
+                (inc.type == Types.Incident.PENALTY_KICK and inc.scored)
+            if scored and inc.participant is not None:
+                goals.setdefault(inc.participant.id, [inc.participant, inc.team, 0])[2] += 1
+        return [(player, team, count) for (player, team, count) in goals.values()]
+
 
 # --------------------------------------------------------------------------------------------------------------------
 # Lexicalization
@@ -633,65 +1368,131 @@ class MorphParams:
     tense: Types.Morph.Tense
     ref: None
     agr: None
+    number: Types.Morph.Number
+    # parsed params and morph() arguments by string id, skeletons repeat a handful of them
+    _parsed: Dict[str, tuple] = {}
+    _arguments: Dict[str, str] = {}
 
     def __init__(self, string_id: str):
-        params = MorphParams.get_morph_params(string_id)
+        self.string_id = string_id
+        params = MorphParams._parsed.get(string_id)
+        if params is None:
+            params = MorphParams._parsed[string_id] = MorphParams.get_morph_params(string_id)
         self.case = params[0]
         self.tense = params[1]
         self.ref = params[2]
         self.agr = params[3]
+        self.number = params[4]
 
     @staticmethod
-    def get_morph_params(string_id: str) -> (Types.Morph.Case, Types.Morph.Tense, str, str):
+    def get_morph_params(string_id: str) -> (Types.Morph.Case, Types.Morph.Tense, str, str, Types.Morph.Number):
         if string_id == '':
-            return None, None, None, None
+            return None, None, None, None, None
         else:
-            [case_id, tense_id, ref_id, agr_id] = string_id.split('-')
+            # number is optional -> 'case-tense-ref-agr' or 'case-tense-ref-agr-number'
+            ids = string_id.split('-')
+            [case_id, tense_id, ref_id, agr_id] = ids[:4]
+            number_id = ids[4] if len(ids) > 4 else "."
 
             case = None if case_id == "." else Types.Morph.Case(int(case_id))
             tense = None if tense_id == "." else Types.Morph.Tense(int(tense_id))
             ref = None if ref_id == "." else ref_id
             agr = None if agr_id == "." else agr_id
+            number = None if number_id == "." else Types.Morph.Number(int(number_id))
 
-            return case, tense, ref, agr
+            return case, tense, ref, agr, number
 
     def apply_morph_params_to_string(self, constituent: str) -> str:
-        header = '{{' + f'\'{constituent}\'|morph('
+        body = MorphParams._arguments.get(self.string_id)
+        if body is None:
+            body = MorphParams._arguments[self.string_id] = self.get_morph_arguments()
 
+        return constituent if body == '' else '{{' + f'\'{constituent}\'|morph(' + body + ')}}'
+
+    def get_morph_arguments(self) -> str:
         mp: List[str] = []
-        all_none = True
 
         if self.case is not None:
             mp.append(f'\'Case={MorphParams.to_valid_form(self.case.name)}\'')
-            all_none = False
 
         if self.tense is not None:
             mp.append(f'\'Tense={MorphParams.to_valid_form(self.tense.name)}\'')
-            all_none = False
+
+        if self.number is not None:
+            mp.append(f'\'Number={MorphParams.to_valid_form(self.number.name)}\'')
 
         if self.ref is not None:
             mp.append(f'ref={self.ref}')
-            all_none = False
 
         if self.agr is not None:
             mp.append(f'ref={self.agr}')
-            all_none = False
-
-        body = ", ".join(mp)
 
-        return constituent if all_none else header + body + ')}}'
+        return ", ".join(mp)
 
     @staticmethod
     def to_valid_form(s: str) -> str:
         return s.lower().capitalize()
 
 
+# surface forms of a player, computed once per match
+@dataclass(frozen=True)
+class PlayerForms:
+    full_name: str
+    short_name: str
+
+    @staticmethod
+    def create(player: Player, ambiguous_last_names: set):
+        last_name = player.get_last_name()
+        # players sharing the last name are always referred to by full name
+        short_name = player.full_name if last_name in ambiguous_last_names else last_name
+        return PlayerForms(full_name=player.full_name, short_name=short_name)
+
+
+# remembers earlier mentions of players in one document
+#   - first mention uses the full name, later mentions the short form
+class MentionTracker:
+    forms: Dict[int, PlayerForms]
+    mentions: Dict[int, int]
+
+    def __init__(self, match_data: MatchData):
+        players: List[Player] = match_data.team_home.lineup + match_data.team_away.lineup
+
+        last_names: Dict[str, int] = {}
+        for player in players:
+            last_name = player.get_last_name()
+            last_names[last_name] = last_names.get(last_name, 0) + 1
+        self._ambiguous_last_names = {name for name, count in last_names.items() if count > 1}
+
+        self.forms = {player.id: PlayerForms.create(player, self._ambiguous_last_names) for player in players}
+        self.mentions = {}
+
+    def get_forms(self, player: Player) -> PlayerForms:
+        if player.id not in self.forms:
+            # e.g. coach getting a card
+            self.forms[player.id] = PlayerForms.create(player, self._ambiguous_last_names)
+        return self.forms[player.id]
+
+    def refer_player(self, player: Player) -> Tuple[str, str]:
+        forms = self.get_forms(player)
+
+        count = self.mentions.get(player.id, 0)
+        self.mentions[player.id] = count + 1
+
+        if count == 0:
+            return 'e-player-1', forms.full_name
+        else:
+            return 'e-player-2', forms.short_name
+
+
 class Template:
     id: str
     msg: Message
     morph_params: MorphParams
     data: None
     string: str
+    # word and verb synonyms by type, built on first use
+    _words: Dict[str, List[Tuple[str, str]]] = None
+    _verbs: Dict[str, List[Tuple[str, str]]] = None
 
     def __init__(self, id: str, msg: Message, morph_params: str, data, string):
         self.id = id
@@ -700,7 +1501,17 @@ class Template:
         self.data = data
         self.string = string
 
-    def lexicalize(self):
+    def lexicalize(self, tracker: MentionTracker = None, rng: random.Random = random):
+        if self.id == 'e-player' and tracker is not None:
+            (self.id, self.string) = tracker.refer_player(self.data)
+            return
+
+        (new_id, new_string) = Template.get_random_poss(self.get_possibilities(), rng)
+
+        self.id = new_id
+        self.string = new_string
+
+    def get_possibilities(self) -> List[Tuple[str, str]]:
         constituent_type = self.id.split('-')[0]
         possibilities: List[Tuple[str, str]] = []
 
@@ -713,10 +1524,7 @@ class Template:
             verb_type = self.id.split('-')[1]
             possibilities = Template.get_string_poss_verb(verb_type)
 
-        (new_id, new_string) = Template.get_random_poss(possibilities)
-
-        self.id = new_id
-        self.string = new_string
+        return possibilities
 
     def get_string_poss_entity(self) -> List[Tuple[str, str]]:
         def init_time_templates():
@@ -747,6 +1555,11 @@ class Template:
             score: Score = self.data
             templates.append(('e-score-1', f"{score.goals_home}:{score.goals_away}"))
 
+        def init_goals_templates():
+            goals: int = self.data
+            words = {2: 'dva góly', 3: 'tři góly', 4: 'čtyři góly'}
+            templates.append(('e-goals-1', words.get(goals, f"{goals} gólů")))
+
         templates: List[(str, str)] = []
 
         ent = self.id.split('-')[1]
@@ -758,6 +1571,8 @@ class Template:
             init_team_templates()
         elif ent == 'score':
             init_score_templates()
+        elif ent == 'goals':
+            init_goals_templates()
         else:
             print("Type Unknown")
 
@@ -790,9 +1605,11 @@ class Template:
             templates.append(('w-redcard-1', 'červená'))
             templates.append(('w-redcard-2', 'červená karta'))
 
-        templates: List[(str, str)] = []
-        init_word_templates()
-        return [t for t in templates if t[0].split('-')[1] == word_type]
+        if Template._words is None:
+            templates: List[(str, str)] = []
+            init_word_templates()
+            Template._words = Template._group_by_type(templates)
+        return Template._words.get(word_type, [])
 
     @staticmethod
     def get_string_poss_verb(verb_type: str) -> List[Tuple[str, str]]:
@@ -832,195 +1649,306 @@ class Template:
             templates.append(('v-card-1', 'dostat'))
             templates.append(('v-card-2', 'obdržet'))
 
-        templates: List[(str, str)] = []
-        init_verb_templates()
-        return [t for t in templates if t[0].split('-')[1] == verb_type]
+        if Template._verbs is None:
+            templates: List[(str, str)] = []
+            init_verb_templates()
+            Template._verbs = Template._group_by_type(templates)
+        return Template._verbs.get(verb_type, [])
+
+    @staticmethod
+    def _group_by_type(templates: List[Tuple[str, str]]) -> Dict[str, List[Tuple[str, str]]]:
+        groups: Dict[str, List[Tuple[str, str]]] = {}
+        for t in templates:
+            groups.setdefault(t[0].split('-')[1], []).append(t)
+        return groups
 
     @staticmethod
-    def get_random_poss(possibilities: List[Tuple[str, str]]) -> Tuple[str, str]:
-        return random.choice(possibilities)
+    def get_random_poss(possibilities: List[Tuple[str, str]], rng: random.Random = random) -> Tuple[str, str]:
+        return rng.choice(possibilities)
 
     def transform_string_for_geneea(self):
         self.string = self.morph_params.apply_morph_params_to_string(self.string)
 
 
+# sentence skeleton ids with functions building their constituents
+SkeletonBuilders = List[Tuple[str, Callable[[], List[Union[str, Template]]]]]
+
+
 class Sentence:
     id: str
     constituents: List[Union[str, Template]]
 
-    def __init__(self, msg: Message):
-        s = Sentence.get_sentence(msg)
+    def __init__(self, msg: Message, rng: random.Random = random,
+                 skeleton: Tuple[str, List[Union[str, Template]]] = None):
+        s = skeleton if skeleton is not None else Sentence.get_sentence(msg, rng)
         self.id = s[0]
         self.constituents = s[1]
 
     @staticmethod
-    def get_sentence(m: Message) -> (str, List[Union[str, Template]]):
-        def get_sentence_result(msg: Messages.Result) -> (str, List[Union[str, Template]]):
-            # id type: result = 'r'
-            # id subtypes: win = 'w' / draw = 'd' / loss = 'l'
-
-            sentences: List[Tuple[str, List[Union[str, Template]]]] = []
-
-            if msg.score.result == Types.Result.WIN:
-                sentences.append(('s_r_w_1', [
-                    Template(id='e-team', msg=msg, morph_params='1-.-1-.', data=msg.team_home, string=None),
-                    Template(id='v-win', msg=msg, morph_params='.-0-.-1', data=None, string=None),
-                    Template(id='e-team', msg=msg, morph_params='4-.-.-.', data=msg.team_away, string=None),
-                    Template(id='e-score', msg=msg, morph_params='', data=msg.score, string=None)
-                ]))
-
-            elif msg.score.result == Types.Result.DRAW:
-                sentences.append(('s_r_d_1', [
-                    Template(id='e-team', msg=msg, morph_params='1-.-1-.', data=msg.team_home, string=None),
-                    Template(id='v-draw', msg=msg, morph_params='.-0-.-1', data=None, string=None),
-                    Template(id='e-team', msg=msg, morph_params='7-.-.-.', data=msg.team_away , string=None),
-                    Template(id='e-score', msg=msg, morph_params='', data=msg.score, string=None),
-
-                ]))
-            else:  # msg.score.result == Types.Result.LOSS:
-                sentences.append(('s_r_l_1', [
-                    Template(id='e-team', msg=msg, morph_params='1-.-1-.', data=msg.team_home , string=None),
-                    Template(id='v-loss', msg=msg, morph_params='.-0-.-1', data=None, string=None),
-                    Template(id='e-team', msg=msg, morph_params='4-.-.-.', data=msg.team_away, string=None),
-                    Template(id='e-score', msg=msg, morph_params='', data=msg.score, string=None),
-                ]))
-
-            return random.choice(sentences)
-
-        def get_sentence_goal(msg: Messages.Goal) -> (str, List[Union[str, Template]]):
-            # id type: goal = 'r'
-            # id subtypes: solo play = 's' / own goal = 'o' / penalty = 'p' / assistance = 'a'
-
-            sentences: List[(str, List[Union[str, Template]])] = []
-            if msg.goal_type == Types.Goal.SOLO_PLAY:
-                sentences.append(('s_g_s_1', [
-
-                    Template(id='e-time'  , msg=msg, morph_params='', data=msg.time          , string=None),
-                    Template(id='v-goal'  , msg=msg, morph_params='.-0-.-.', data=None              , string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant   , string=None),
-                    Template(id='w-goal'  , msg=msg, morph_params='4-.-.-.', data=None              , string=None),
-                ]))
-
-                sentences.append(('s_g_s_2', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    Template(id='v-goal', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    Template(id='w-goal', msg=msg, morph_params='4-.-.-.', data=None, string=None),
-                    "a",
-                    Template(id='v-score_change', msg=msg, morph_params='', data=None, string=None),
-                    "na",
-                    Template(id='e-score', msg=msg, morph_params='', data=msg.current_score, string=None)
-                ]))
-
-            elif msg.goal_type == Types.Goal.ASSISTANCE:
-                sentences.append(('s_g_a_1', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    Template(id='v-goal', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    "po",
-                    Template(id='w-assistance', msg=msg, morph_params='6-.-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='3-.-.-.', data=msg.assistance, string=None),
-                    Template(id='w-goal', msg=msg, morph_params='4-.-.-.', data=None, string=None)
-                ]))
-            elif msg.goal_type == Types.Goal.PENALTY:
-                sentences.append(('s_g_p_1', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    Template(id='v-penalty', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    Template(id='w-penalty', msg=msg, morph_params='4-.-.-.', data=None, string=None)
-                ]))
-            elif msg.goal_type == Types.Goal.OWN_GOAL:
-                sentences.append(('s_g_p_1', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    "si dal",
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    Template(id='w-own_goal', msg=msg, morph_params='4-.-.-.', data=None, string=None)
-                ]))
-
-            return random.choice(sentences)
-
-        def get_sentence_substitution(msg: Messages.Substitution) -> (str, List[Union[str, Template]]):
-            # id type: substitution = 's'
-
-            sentences : List[(str, List[Union[str, Template]])] = []
-
-            sentences.append(('s_s_1', [
-                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                Template(id='v-substitution', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant_in, string=None),
-                "za",
-                Template(id='e-player', msg=msg, morph_params='4-.-.-.', data=msg.participant_out, string=None),
-            ]))
-            sentences.append(('s_s_2', [
-                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                Template(id='v-substitution', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant_in, string=None),
-                Template(id='e-player', msg=msg, morph_params='4-.-.-.', data=msg.participant_out, string=None),
-            ]))
-
-            return random.choice(sentences)
-
-        def get_sentence_card(msg: Messages.Card) -> (str, List[Union[str, Template]]):
-            # id type: card = 'c'
-            # id subtypes: red_auto = 'a' / red_instant = 'r' / yellow = 'y'
-
-            sentences: List[(str, List[Union[str, Template]])] = []
-            if msg.card_type == Types.Card.RED_AUTO:
-                sentences.append(('s_g_s_1', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    Template(id='w-redcard', msg=msg, morph_params='4-.-.-.', data= None, string= None)
-                ]))
-            elif msg.card_type == Types.Card.RED_INSTANT:
-                sentences.append(('s_g_s_1', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    "druhou",
-                    Template(id='w-yellowcard', msg=msg, morph_params='4-.-.-.', data=None, string=None),
-                    "a tím pro něj zápas skončil"
-                ]))
-            else:  # msg.card_type == Types.Card.YELLOW:
-                sentences.append(('s_g_s_1', [
-                    Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                    Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
-                    Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
-                    Template(id='w-yellowcard', msg=msg, morph_params='4-.-.-.', data=None, string=None)
-                ]))
-
-            return random.choice(sentences)
-
-        def get_sentence_missed_penalty(msg: Messages.MissedPenalty) -> (str, List[Union[str,Template]]):
-            # id type: missed penalty = 'm'
-            sentences: List[(str, List[Union[str,Template]])] = []
-
-            sentences.append(('s_m_1', [
-                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
-                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant_in, string=None),
-                Template(id='v-failed_penalty', msg=msg, morph_params='.-0-.-.', data=msg.time, string=None),
-                Template(id='w-penalty', msg=msg, morph_params='', data=msg.participant_out, string=None)
-            ]))
+    def get_sentence(m: Message, rng: random.Random = random) -> (str, List[Union[str, Template]]):
+        (sentence_id, build) = rng.choice(Sentence.get_skeletons(m))
+        return sentence_id, build()
 
-            return random.choice(sentences)
+    # all sentence skeletons expressing the message
+    @staticmethod
+    def get_sentences(m: Message) -> List[Tuple[str, List[Union[str, Template]]]]:
+        return [(sentence_id, build()) for (sentence_id, build) in Sentence.get_skeletons(m)]
 
+    # skeleton ids with functions building their constituents, only the chosen skeleton has to be built
+    @staticmethod
+    def get_skeletons(m: Message) -> SkeletonBuilders:
         if type(m) is Messages.Result:
-            return get_sentence_result(m)
+            return Sentence._get_skeletons_result(m)
         elif type(m) is Messages.Goal:
-            return get_sentence_goal(m)
+            return Sentence._get_skeletons_goal(m)
         elif type(m) is Messages.Substitution:
-            return get_sentence_substitution(m)
+            return Sentence._get_skeletons_substitution(m)
         elif type(m) is Messages.Card:
-            return get_sentence_card(m)
+            return Sentence._get_skeletons_card(m)
         elif type(m) is Messages.MissedPenalty:
-            return get_sentence_missed_penalty(m)
+            return Sentence._get_skeletons_missed_penalty(m)
+        elif type(m) is Messages.Substitutions:
+            return Sentence._get_skeletons_substitutions(m)
+        elif type(m) is Messages.Cards:
+            return Sentence._get_skeletons_cards(m)
+        elif type(m) is Messages.SecondYellow:
+            return Sentence._get_skeletons_second_yellow(m)
+        elif type(m) is Messages.Scorer:
+            return Sentence._get_skeletons_scorer(m)
         else:
             print("Wrong types")
 
-    def lexicalize(self):
+    @staticmethod
+    def _get_skeletons_result(msg: Messages.Result) -> SkeletonBuilders:
+        # id type: result = 'r'
+        # id subtypes: win = 'w' / draw = 'd' / loss = 'l'
+
+        sentences: SkeletonBuilders = []
+
+        if msg.score.result == Types.Result.WIN:
+            sentences.append(('s_r_w_1', lambda: [
+                Template(id='e-team', msg=msg, morph_params='1-.-1-.', data=msg.team_home, string=None),
+                Template(id='v-win', msg=msg, morph_params='.-0-.-1', data=None, string=None),
+                Template(id='e-team', msg=msg, morph_params='4-.-.-.', data=msg.team_away, string=None),
+                Template(id='e-score', msg=msg, morph_params='', data=msg.score, string=None)
+            ]))
+
+        elif msg.score.result == Types.Result.DRAW:
+            sentences.append(('s_r_d_1', lambda: [
+                Template(id='e-team', msg=msg, morph_params='1-.-1-.', data=msg.team_home, string=None),
+                Template(id='v-draw', msg=msg, morph_params='.-0-.-1', data=None, string=None),
+                Template(id='e-team', msg=msg, morph_params='7-.-.-.', data=msg.team_away , string=None),
+                Template(id='e-score', msg=msg, morph_params='', data=msg.score, string=None),
+
+            ]))
+        else:  # msg.score.result == Types.Result.LOSS:
+            sentences.append(('s_r_l_1', lambda: [
+                Template(id='e-team', msg=msg, morph_params='1-.-1-.', data=msg.team_home , string=None),
+                Template(id='v-loss', msg=msg, morph_params='.-0-.-1', data=None, string=None),
+                Template(id='e-team', msg=msg, morph_params='4-.-.-.', data=msg.team_away, string=None),
+                Template(id='e-score', msg=msg, morph_params='', data=msg.score, string=None),
+            ]))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_goal(msg: Messages.Goal) -> SkeletonBuilders:
+        # id type: goal = 'r'
+        # id subtypes: solo play = 's' / own goal = 'o' / penalty = 'p' / assistance = 'a'
+
+        sentences: SkeletonBuilders = []
+        if msg.goal_type == Types.Goal.SOLO_PLAY:
+            sentences.append(('s_g_s_1', lambda: [
+
+                Template(id='e-time'  , msg=msg, morph_params='', data=msg.time          , string=None),
+                Template(id='v-goal'  , msg=msg, morph_params='.-0-.-.', data=None              , string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant   , string=None),
+                Template(id='w-goal'  , msg=msg, morph_params='4-.-.-.', data=None              , string=None),
+            ]))
+
+            sentences.append(('s_g_s_2', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                Template(id='v-goal', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                Template(id='w-goal', msg=msg, morph_params='4-.-.-.', data=None, string=None),
+                "a",
+                Template(id='v-score_change', msg=msg, morph_params='', data=None, string=None),
+                "na",
+                Template(id='e-score', msg=msg, morph_params='', data=msg.current_score, string=None)
+            ]))
+
+        elif msg.goal_type == Types.Goal.ASSISTANCE:
+            sentences.append(('s_g_a_1', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                Template(id='v-goal', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                "po",
+                Template(id='w-assistance', msg=msg, morph_params='6-.-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='3-.-.-.', data=msg.assistance, string=None),
+                Template(id='w-goal', msg=msg, morph_params='4-.-.-.', data=None, string=None)
+            ]))
+        elif msg.goal_type == Types.Goal.PENALTY:
+            sentences.append(('s_g_p_1', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                Template(id='v-penalty', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                Template(id='w-penalty', msg=msg, morph_params='4-.-.-.', data=None, string=None)
+            ]))
+        elif msg.goal_type == Types.Goal.OWN_GOAL:
+            sentences.append(('s_g_p_1', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                "si dal",
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                Template(id='w-own_goal', msg=msg, morph_params='4-.-.-.', data=None, string=None)
+            ]))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_substitution(msg: Messages.Substitution) -> SkeletonBuilders:
+        # id type: substitution = 's'
+
+        sentences: SkeletonBuilders = []
+
+        sentences.append(('s_s_1', lambda: [
+            Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+            Template(id='v-substitution', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+            Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant_in, string=None),
+            "za",
+            Template(id='e-player', msg=msg, morph_params='4-.-.-.', data=msg.participant_out, string=None),
+        ]))
+        sentences.append(('s_s_2', lambda: [
+            Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+            Template(id='v-substitution', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+            Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant_in, string=None),
+            Template(id='e-player', msg=msg, morph_params='4-.-.-.', data=msg.participant_out, string=None),
+        ]))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_card(msg: Messages.Card) -> SkeletonBuilders:
+        # id type: card = 'c'
+        # id subtypes: red_auto = 'a' / red_instant = 'r' / yellow = 'y'
+
+        sentences: SkeletonBuilders = []
+        if msg.card_type == Types.Card.RED_AUTO:
+            sentences.append(('s_g_s_1', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                Template(id='w-redcard', msg=msg, morph_params='4-.-.-.', data= None, string= None)
+            ]))
+        elif msg.card_type == Types.Card.RED_INSTANT:
+            sentences.append(('s_g_s_1', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                "druhou",
+                Template(id='w-yellowcard', msg=msg, morph_params='4-.-.-.', data=None, string=None),
+                "a tím pro něj zápas skončil"
+            ]))
+        else:  # msg.card_type == Types.Card.YELLOW:
+            sentences.append(('s_g_s_1', lambda: [
+                Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+                Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+                Template(id='w-yellowcard', msg=msg, morph_params='4-.-.-.', data=None, string=None)
+            ]))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_missed_penalty(msg: Messages.MissedPenalty) -> SkeletonBuilders:
+        # id type: missed penalty = 'm'
+        sentences: SkeletonBuilders = []
+
+        sentences.append(('s_m_1', lambda: [
+            Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+            Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant_in, string=None),
+            Template(id='v-failed_penalty', msg=msg, morph_params='.-0-.-.', data=msg.time, string=None),
+            Template(id='w-penalty', msg=msg, morph_params='', data=msg.participant_out, string=None)
+        ]))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_substitutions(msg: Messages.Substitutions) -> SkeletonBuilders:
+        # id type: aggregated substitutions = 'ss'
+        sentences: SkeletonBuilders = []
+
+        constituents: List[Union[str, Template]] = [
+            Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+            Template(id='v-substitution', msg=msg, morph_params='.-0-.-.-1', data=None, string=None),
+        ]
+        for k, (p_out, p_in) in enumerate(msg.participants):
+            if k != 0:
+                constituents.append("a" if k == len(msg.participants) - 1 else ",")
+            constituents += [
+                Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=p_in, string=None),
+                "za",
+                Template(id='e-player', msg=msg, morph_params='4-.-.-.', data=p_out, string=None),
+            ]
+        sentences.append(('s_ss_1', lambda: constituents))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_cards(msg: Messages.Cards) -> SkeletonBuilders:
+        # id type: aggregated cards = 'cc'
+        sentences: SkeletonBuilders = []
+
+        constituents: List[Union[str, Template]] = [
+            Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+            Template(id='v-card', msg=msg, morph_params='.-0-.-.-1', data=None, string=None),
+        ]
+        for k, participant in enumerate(msg.participants):
+            if k != 0:
+                constituents.append("a" if k == len(msg.participants) - 1 else ",")
+            constituents.append(Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=participant,
+                                         string=None))
+        constituents.append(Template(id='w-yellowcard', msg=msg, morph_params='4-.-.-.', data=None, string=None))
+        sentences.append(('s_cc_1', lambda: constituents))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_second_yellow(msg: Messages.SecondYellow) -> SkeletonBuilders:
+        # id type: second yellow card = 'cy'
+        sentences: SkeletonBuilders = []
+
+        sentences.append(('s_cy_1', lambda: [
+            Template(id='e-time', msg=msg, morph_params='', data=msg.time, string=None),
+            Template(id='v-card', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+            Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+            "po žluté",
+            Template(id='e-time', msg=msg, morph_params='', data=msg.first_time, string=None),
+            "i druhou",
+            Template(id='w-yellowcard', msg=msg, morph_params='4-.-.-.', data=None, string=None),
+            "a byl vyloučen"
+        ]))
+
+        return sentences
+
+    @staticmethod
+    def _get_skeletons_scorer(msg: Messages.Scorer) -> SkeletonBuilders:
+        # id type: standout scorer of a round = 'sc'
+        sentences: SkeletonBuilders = []
+
+        sentences.append(('s_sc_1', lambda: [
+            Template(id='e-player', msg=msg, morph_params='1-.-.-.', data=msg.participant, string=None),
+            Template(id='v-goal', msg=msg, morph_params='.-0-.-.', data=None, string=None),
+            Template(id='e-goals', msg=msg, morph_params='', data=msg.goals, string=None),
+            "proti",
+            Template(id='e-team', msg=msg, morph_params='3-.-.-.', data=msg.opponent, string=None),
+        ]))
+
+        return sentences
+
+    def lexicalize(self, tracker: MentionTracker = None, rng: random.Random = random):
         for tmp in self.constituents:
             if type(tmp) is Template:
-                tmp.lexicalize()
+                tmp.lexicalize(tracker, rng)
 
     def transform_strings_for_geneea(self):
         for tmp in self.constituents:
@@ -1041,24 +1969,166 @@ class Sentence:
             k += 1
         const[0] = const[0][:k] + const[0][k].upper() + const[0][k+1:]
 
-        return ' '.join(const) + '.'
+        return ' '.join(const).replace(' ,', ',') + '.'
+
+
+# draws many choices at once, vectorized with NumPy when it is installed
+#   - the same seed gives the same draws, NumPy and the fallback draw differently
+class ChoiceDrawer:
+    def __init__(self, seed: int):
+        self._generator = numpy.random.default_rng(seed) if numpy is not None else None
+        self._rng = random.Random(seed)
+
+    # index of the choice for every count of possibilities
+    def draw(self, counts: List[int]) -> List[int]:
+        if not counts:
+            return []
+        if self._generator is not None:
+            return self._generator.integers(0, numpy.asarray(counts)).tolist()
+        return [int(self._rng.random() * n) for n in counts]
 
 
 class Lexicalizer:
+    SEED = 10
+    # attempts to draw distinct variants before giving up
+    VARIANT_ATTEMPTS = 4
 
+    # trace, if given, gets [skeleton id, template ids, incident positions] of every sentence, title first
     @staticmethod
-    def lexicalize(doc_plan: DocumentPlan, match_data: MatchData) -> (str, List[str]):
+    def lexicalize(doc_plan: DocumentPlan, match_data: MatchData, rng: random.Random = None,
+                   trace: List[list] = None) -> (str, List[str]):
+        if rng is None:
+            rng = random.Random(Lexicalizer.SEED)  # same seed for every article
+        tracker = MentionTracker(match_data)
+        sources = doc_plan.sources or [() for _ in doc_plan.body]
+
+        title = Lexicalizer._lexicalize_message(doc_plan.title, tracker, rng, trace)
+        body = [Lexicalizer._lexicalize_message(msg, tracker, rng, trace, source)
+                for msg, source in zip(doc_plan.body, sources)]
+        return title, body
 
-        random.seed(10)  # setting the seed for whole program
+    @staticmethod
+    def lexicalize_variants(doc_plan: DocumentPlan, match_data: MatchData, n: int,
+                            traces: List[List[list]] = None) -> List[Tuple[str, List[str]]]:
+        # every variant has its own random stream, the first one equals the output of lexicalize
+        variants: List[Tuple[str, List[str]]] = []
+        for k in range(n * Lexicalizer.VARIANT_ATTEMPTS):
+            trace: List[list] = []
+            plain_str = Lexicalizer.lexicalize(doc_plan, match_data, random.Random(Lexicalizer.SEED + k), trace)
+            if plain_str not in variants:
+                variants.append(plain_str)
+                if traces is not None:
+                    traces.append(trace)
+            if len(variants) == n:
+                break
+        return variants
 
-        title = Lexicalizer._lexicalize_message(doc_plan.title)
-        body = [Lexicalizer._lexicalize_message(msg) for msg in doc_plan.body]
-        return title, body
+    @staticmethod
+    def lexicalize_round(round_plan: RoundPlan, match_data: List[MatchData],
+                         rng: random.Random = None) -> (str, List[str]):
+        if rng is None:
+            rng = random.Random(Lexicalizer.SEED)
+        trackers: Dict[int, MentionTracker] = {}
+
+        body: List[str] = []
+        for msg, k in zip(round_plan.body, round_plan.matches):
+            if k not in trackers:
+                trackers[k] = MentionTracker(match_data[k])
+            body.append(Lexicalizer._lexicalize_message(msg, trackers[k], rng))
+        return round_plan.title, body
+
+    # same wording as the traced article, player names and other data come from the given match data
+    @staticmethod
+    def replay(trace: List[list], match_data: MatchData) -> (str, List[str]):
+        tracker = MentionTracker(match_data)
+        strings: List[str] = []
+        for (sentence_id, template_ids, sources) in trace:
+            msg = Lexicalizer._rebuild_message(match_data, sources)
+            skeleton = dict(Sentence.get_sentences(msg)).get(sentence_id)
+            if skeleton is None:
+                raise ValueError(f"Sentence {sentence_id} of the trace doesn't fit the match data")
+            sentence = Sentence(msg, skeleton=(sentence_id, skeleton))
+
+            templates = [c for c in sentence.constituents if type(c) is Template]
+            if len(templates) != len(template_ids):
+                raise ValueError(f"Sentence {sentence_id} of the trace doesn't fit the match data")
+            for template, template_id in zip(templates, template_ids):
+                if template.id == 'e-player':
+                    forms = tracker.get_forms(template.data)
+                    template.string = forms.full_name if template_id == 'e-player-1' else forms.short_name
+                else:
+                    template.string = dict(template.get_possibilities()).get(template_id)
+                    if template.string is None:
+                        raise ValueError(f"Template {template_id} of the trace doesn't fit the match data")
+                template.id = template_id
+
+            sentence.transform_strings_for_geneea()
+            strings.append(sentence.get_string())
+        return strings[0], strings[1:]
+
+    @staticmethod
+    def _rebuild_message(match_data: MatchData, sources: List[int]) -> Messages:
+        if not sources:
+            return DocumentPlanner._plan_title(match_data)
+        # aggregated messages are merged again from their incidents only
+        body = [DocumentPlanner._plan_incident_msg(match_data.incidents[k]) for k in sources]
+        body = Aggregator.aggregate(DocumentPlan.create(None, body)).body
+        if len(body) != 1:
+            raise ValueError(f"Incidents {sources} of the trace don't form one message")
+        return body[0]
+
+    # documents of many matches lexicalized together, choices are drawn for whole groups of constituents
+    @staticmethod
+    def lexicalize_batch(doc_plans: List[DocumentPlan], match_data: List[MatchData],
+                         seed: int = None) -> List[Tuple[str, List[str]]]:
+        drawer = ChoiceDrawer(Lexicalizer.SEED if seed is None else seed)
+        documents: List[List[Messages]] = [[doc_plan.title] + doc_plan.body for doc_plan in doc_plans]
+
+        # sentence skeletons, only the drawn one is built
+        messages = [msg for document in documents for msg in document]
+        candidates = [Sentence.get_skeletons(msg) for msg in messages]
+        sentences = [Sentence(msg, skeleton=(c[k][0], c[k][1]())) for msg, c, k in
+                     zip(messages, candidates, drawer.draw([len(c) for c in candidates]))]
+
+        # constituents grouped by type, e.g. 'v-goal', players are referred to per document below
+        groups: Dict[str, List[Template]] = {}
+        for sentence in sentences:
+            for c in sentence.constituents:
+                if type(c) is Template and c.id != 'e-player':
+                    groups.setdefault(c.id, []).append(c)
+
+        for constituent_id in sorted(groups):
+            templates = groups[constituent_id]
+            if constituent_id.startswith('e-'):
+                # entity possibilities depend on the data
+                possibilities = [t.get_possibilities() for t in templates]
+            else:
+                possibilities = [templates[0].get_possibilities()] * len(templates)
+            for t, poss, k in zip(templates, possibilities, drawer.draw([len(p) for p in possibilities])):
+                (t.id, t.string) = poss[k]
+
+        plain_strs: List[Tuple[str, List[str]]] = []
+        start = 0
+        for document, data in zip(documents, match_data):
+            tracker = MentionTracker(data)
+            strings: List[str] = []
+            for sentence in sentences[start:start + len(document)]:
+                for c in sentence.constituents:
+                    if type(c) is Template and c.id == 'e-player':
+                        (c.id, c.string) = tracker.refer_player(c.data)
+                sentence.transform_strings_for_geneea()
+                strings.append(sentence.get_string())
+            start += len(document)
+            plain_strs.append((strings[0], strings[1:]))
+        return plain_strs
 
     @staticmethod
-    def _lexicalize_message(msg: Messages) -> str:
-        sentence = Sentence(msg)
-        sentence.lexicalize()
+    def _lexicalize_message(msg: Messages, tracker: MentionTracker, rng: random.Random, trace: List[list] = None,
+                            sources: Tuple[int, ...] = ()) -> str:
+        sentence = Sentence(msg, rng)
+        sentence.lexicalize(tracker, rng)
+        if trace is not None:
+            trace.append([sentence.id, [c.id for c in sentence.constituents if type(c) is Template], list(sources)])
         # sentence.alternate()
         sentence.transform_strings_for_geneea()
         return sentence.get_string()
@@ -1066,14 +2136,315 @@ class Lexicalizer:
 # --------------------------------------------------------------------------------------------------------------------
 # Realization of str from Lexicalizer
 
+# client side token bucket for the Geneea endpoint
+#   - rate is halved on throttling (429/503) and slowly restored on success
+#   - Retry-After blocks all callers until the given time
+class RateLimiter:
+    rate: float
+    max_rate: float
+    min_rate: float
+    burst: int
+
+    def __init__(self, rate: float, burst: int, min_rate: float = 0.1):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        # 429s of requests sent before the rate was lowered don't lower it again
+        self._throttled_until = 0.0
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self.throttles = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    # monotonic time until which Retry-After blocks all requests
+    @property
+    def blocked_until(self) -> float:
+        return self._blocked_until
+
+    # False when no token is available before end (monotonic time)
+    def acquire(self, end: float = None) -> bool:
+        with self._lock:
+            self._waiting += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._waiting)
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    if end is not None and now >= end:
+                        return False
+                    self._refill(now)
+                    if now >= self._blocked_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+                if end is not None and now + wait > end:
+                    return False
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def on_throttle(self, retry_after: float = None):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = 0
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            if now < self._throttled_until:
+                return
+            # decreased at most once per throttle window (Retry-After or one refill interval)
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._throttled_until = max(self._blocked_until, now + 1 / self.rate)
+
+    def stats(self) -> str:
+        return f"Rate limiting -- rate: {self.rate:.2f}/s, rate decreases: {self.throttles}, " \
+            f"queue depth: {self.queue_depth}, max queue depth: {self.max_queue_depth}"
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+# memo of inflected forms keyed by (lemma, morph params) and learned from realizer responses
+#   - directives with ref= agree with the other directives of the same ref, their key includes those directives
+#     and a ref group is resolved locally only as a whole
+#   - lowercase directives starting a sentence may be capitalized by the realizer and are not learned
+class InflectionMemo:
+    DIRECTIVE = re.compile(r"\{\{'(.*?)'\|morph\((.*?)\)\}\}")
+    REF = re.compile(r"ref=(\w+)")
+
+    forms: Dict[str, str]
+    hits: int
+    misses: int
+
+    def __init__(self, file_path: str = None):
+        self.file_path = file_path
+        self.forms = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if file_path is not None and os.path.exists(file_path):
+            with open(file_path, encoding='utf-8') as memo_file:
+                self.forms = json.load(memo_file)
+
+    @staticmethod
+    def has_directives(template: str) -> bool:
+        return InflectionMemo.DIRECTIVE.search(template) is not None
+
+    @staticmethod
+    def _get_keys(directives: List[re.Match]) -> List[str]:
+        groups: Dict[str, List[str]] = {}
+        refs: List[str] = []
+        for d in directives:
+            ref = InflectionMemo.REF.search(d.group(2))
+            refs.append(ref.group(1) if ref is not None else None)
+            if ref is not None:
+                groups.setdefault(ref.group(1), []).append(d.group(1) + '|' + d.group(2))
+
+        keys: List[str] = []
+        for d, ref in zip(directives, refs):
+            key = d.group(1) + '|' + d.group(2)
+            if ref is not None:
+                key += '\t' + '\t'.join(sorted(groups[ref]))
+            keys.append(key)
+        return keys
+
+    def resolve(self, template: str) -> str:
+        directives = list(InflectionMemo.DIRECTIVE.finditer(template))
+        keys = InflectionMemo._get_keys(directives)
+
+        with self._lock:
+            # a ref group is resolved only when all its forms are known
+            unknown_refs = {InflectionMemo._get_ref(d) for d, key in zip(directives, keys) if key not in self.forms}
+
+            parts: List[str] = []
+            end = 0
+            for d, key in zip(directives, keys):
+                parts.append(template[end:d.start()])
+                if key in self.forms and InflectionMemo._get_ref(d) not in unknown_refs - {None}:
+                    parts.append(self.forms[key])
+                    self.hits += 1
+                else:
+                    parts.append(d.group(0))
+                    self.misses += 1
+                end = d.end()
+            parts.append(template[end:])
+
+        return ''.join(parts)
+
+    def learn(self, template: str, article: str):
+        directives = list(InflectionMemo.DIRECTIVE.finditer(template))
+        if not directives:
+            return
+        keys = InflectionMemo._get_keys(directives)
+
+        # template -> regex, literal text has to match, every directive keeps the number of words
+        pattern: List[str] = []
+        learnable: List[bool] = []
+        end = 0
+        for d in directives:
+            literal = template[end:d.start()]
+            pattern.append(InflectionMemo._literal_pattern(literal))
+            words = len(d.group(1).split())
+            pattern.append(r'(\S+' + r'(?:\s+\S+)' * (words - 1) + ')')
+            preceding = template[:d.start()].rstrip()
+            sentence_start = preceding == '' or preceding.endswith('.')
+            learnable.append(not sentence_start or d.group(1)[:1].isupper())
+            end = d.end()
+        pattern.append(InflectionMemo._literal_pattern(template[end:]))
+
+        found = re.fullmatch(''.join(pattern), article.strip(), flags=re.DOTALL)
+        if found is None:
+            return
+
+        with self._lock:
+            for k, key in enumerate(keys):
+                if learnable[k]:
+                    self.forms[key] = found.group(k + 1)
+
+    @staticmethod
+    def _get_ref(directive: re.Match) -> str:
+        ref = InflectionMemo.REF.search(directive.group(2))
+        return ref.group(1) if ref is not None else None
+
+    @staticmethod
+    def _literal_pattern(literal: str) -> str:
+        words = literal.split()
+        if not words:
+            return r'\s*'
+        return r'\s*' + r'\s+'.join(re.escape(w) for w in words) + r'\s*'
+
+    def save(self):
+        if self.file_path is None:
+            return
+        with self._lock:
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as memo_file:
+                json.dump(self.forms, memo_file, ensure_ascii=False)
+            os.replace(tmp_path, self.file_path)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f"Inflection memo -- size: {len(self.forms)}, hits: {self.hits}, misses: {self.misses}, " \
+            f"hit rate: {hit_rate:.1%}"
+
+
+class InFlightRequest:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: dict = None
+        self.error: Exception = None
+
+
+# concurrent calls with the same payload share one request
+#   - keyed by hash of the payload, the key is forgotten as soon as the request finishes
+class RequestCoalescer:
+    requests: int
+    coalesced: int
+
+    def __init__(self):
+        self._in_flight: Dict[str, InFlightRequest] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def get_key(payload: dict) -> str:
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def call(self, payload: dict, send) -> dict:
+        key = RequestCoalescer.get_key(payload)
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = InFlightRequest()
+                self.requests += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = send()
+            return flight.response
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+
+    def stats(self) -> str:
+        return f"Coalescing -- requests: {self.requests}, coalesced: {self.coalesced}"
+
 
 class Realizer:
+    url: str = 'https://generator.geneea.com/generate'
+    rate_limiter: RateLimiter = RateLimiter(rate=5.0, burst=5)
+    max_retries: int = 5
+    backoff_base: float = 0.5
+    backoff_max: float = 30.0
+    timeout: float = 60.0
+    # realization is idempotent, so these are safe to retry
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    THROTTLE_STATUS = {429, 503}
+    _jitter = random.Random()
+    inflection_memo: InflectionMemo = None
+    coalescer: RequestCoalescer = RequestCoalescer()
+    # realization policy, no deadline means waiting for the realizer as long as it retries
+    deadline: float = None
+    hedge_percentile: float = 95.0
+    HEDGE_DELAY = 1.0  # until enough latencies are known
+    HEDGE_MIN_SAMPLES = 20
+    latencies: deque = deque(maxlen=500)
+    hedged = 0
+    hedge_wins = 0
+    degraded = 0
+    # variants realized in one request are separated by this literal
+    VARIANT_SEPARATOR = '###'
+
+    @staticmethod
+    def configure(url: str, rate: float, burst: int, max_retries: int):
+        Realizer.url = url
+        Realizer.rate_limiter = RateLimiter(rate=rate, burst=burst)
+        Realizer.max_retries = max_retries
+
+    @staticmethod
+    def configure_policy(deadline: float, hedge_percentile: float):
+        Realizer.deadline = deadline
+        Realizer.hedge_percentile = hedge_percentile
+
     @staticmethod
     def realize_str(plain_str: (str, List[str])) -> str:
         return f'{plain_str[0]}\n' + "\n" + ("\n".join(plain_str[1]))
 
     @staticmethod
     def create_json_file_for_geneea(plain_str: (str, List[str]), file_path: str):
+        with open(file_path, 'w') as output_json:
+            json.dump(Realizer.create_geneea_input(plain_str), output_json)
+
+    @staticmethod
+    def create_geneea_input(plain_str: (str, List[str])) -> dict:
         data = {}
         data['templates'] = []
         '''
@@ -1092,33 +2463,850 @@ class Realizer:
         })
 
         data['data'] = {}
-        with open(file_path, 'w') as output_json:
-            json.dump(data, output_json)
+        return data
 
     @staticmethod
     def realize_article(plain_str: (str, List[str])) -> str:
-        file_path = r'C:\Users\danra\Skola\MFF\RP\SP_FootballArticle\geneea_input.json'
-        Realizer.create_json_file_for_geneea(plain_str, file_path)
+        return Realizer.realize_geneea_input(Realizer.create_geneea_input(plain_str))
+
+    @staticmethod
+    def realize_articles(plain_strs: List[Tuple[str, List[str]]]) -> List[str]:
+        if len(plain_strs) == 1:
+            return [Realizer.realize_article(plain_strs[0])]
+
+        article = Realizer.realize_geneea_input(Realizer.create_geneea_input_batch(plain_strs))
+        articles = [a.strip() for a in article.split(Realizer.VARIANT_SEPARATOR)]
+        if len(articles) != len(plain_strs):
+            raise ValueError("Realized article variants can't be separated")
+        return articles
+
+    @staticmethod
+    def create_geneea_input_batch(plain_strs: List[Tuple[str, List[str]]]) -> dict:
+        bodies = [plain_str[0] + ' ' + ' '.join(plain_str[1]) for plain_str in plain_strs]
+        return Realizer.create_geneea_input_segments(bodies)
+
+    @staticmethod
+    def create_geneea_input_segments(segments: List[str]) -> dict:
+        return {
+            'templates': [{
+                "id": "tmpl-2",
+                "name": "body template",
+                "body": f' {Realizer.VARIANT_SEPARATOR} '.join(segments)
+            }],
+            'data': {}
+        }
 
-        with open(file_path) as json_file:
-            output_geneea: dict = Realizer.call_geneea(json.load(json_file))
+    # independent pieces of text (e.g. single sentences) realized in one request
+    @staticmethod
+    def realize_segments(segments: List[str]) -> List[str]:
+        if not segments:
+            return []
+        article = Realizer.realize_geneea_input(Realizer.create_geneea_input_segments(segments))
+        realized = [a.strip() for a in article.split(Realizer.VARIANT_SEPARATOR)]
+        if len(realized) != len(segments):
+            raise ValueError("Realized segments can't be separated")
+        return realized
 
-        return output_geneea['article']
+    @staticmethod
+    def realize_geneea_input(geneea_input: dict) -> str:
+        memo = Realizer.inflection_memo
+        if memo is None or len(geneea_input['templates']) != 1:
+            return Realizer.call_geneea(geneea_input)['article']
+
+        # known forms are filled in locally, the realizer gets only the rest
+        template = memo.resolve(geneea_input['templates'][0]['body'])
+        if not InflectionMemo.has_directives(template):
+            return template
+
+        geneea_input = dict(geneea_input, templates=[dict(geneea_input['templates'][0], body=template)])
+        article = Realizer.call_geneea(geneea_input)['article']
+        memo.learn(template, article)
+        return article
+
+    # article(s) realized remotely, or locally when the deadline expires
+    @staticmethod
+    def realize_within_deadline(plain_strs: List[Tuple[str, List[str]]]) -> Tuple[List[str], bool]:
+        try:
+            return Realizer.realize_articles(plain_strs), False
+        except TimeoutError:
+            Realizer.degraded += 1
+            return [Realizer.realize_locally(plain_str) for plain_str in plain_strs], True
+
+    # known inflections come from the memo, the rest stays in the lemma form
+    @staticmethod
+    def realize_locally(plain_str: (str, List[str])) -> str:
+        template = Realizer.create_geneea_input(plain_str)['templates'][0]['body']
+        if Realizer.inflection_memo is not None:
+            template = Realizer.inflection_memo.resolve(template)
+        return InflectionMemo.DIRECTIVE.sub(lambda d: d.group(1), template)
 
     @staticmethod
     def call_geneea(json_file: dict):
-        url = 'https://generator.geneea.com/generate'
+        if Realizer.deadline is None:
+            return Realizer.coalescer.call(json_file, lambda: Realizer._post_geneea(json_file))
+        return Realizer.coalescer.call(json_file, lambda: Realizer._post_hedged(json_file, Realizer.deadline))
+
+    @staticmethod
+    def get_hedge_delay() -> float:
+        latencies = sorted(Realizer.latencies)
+        if len(latencies) < Realizer.HEDGE_MIN_SAMPLES:
+            return Realizer.HEDGE_DELAY
+        return latencies[min(len(latencies) - 1, int(Realizer.hedge_percentile / 100 * len(latencies)))]
+
+    # duplicate request once the first one is slower than the hedge percentile, TimeoutError after the deadline
+    @staticmethod
+    def _post_hedged(json_file: dict, deadline: float) -> dict:
+        end = time.monotonic() + deadline
+        answers: queue.Queue = queue.Queue()
+
+        def send(hedge: bool):
+            start = time.monotonic()
+            try:
+                response = Realizer._post_geneea(json_file, end)
+            except Exception as e:
+                answers.put((hedge, None, e))
+                return
+            Realizer.latencies.append(time.monotonic() - start)
+            answers.put((hedge, response, None))
+
+        # requests still running after the deadline are abandoned, they stop retrying at the deadline
+        threading.Thread(target=send, args=(False,), daemon=True).start()
+        (sent, running) = (1, 1)
+        # a hedge sent later than half of the deadline rarely answers in time
+        hedge_at = time.monotonic() + min(Realizer.get_hedge_delay(), deadline / 2)
+        error: Exception = None
+        while running > 0:
+            can_hedge = sent == 1 and hedge_at < end
+            try:
+                wait_until = hedge_at if can_hedge else end
+                (hedge, response, e) = answers.get(timeout=max(0.0, wait_until - time.monotonic()))
+            except queue.Empty:
+                if not can_hedge:
+                    raise TimeoutError("Realization deadline exceeded")
+                # the hedge would only wait for the Retry-After of the throttled endpoint
+                if Realizer.rate_limiter.blocked_until > time.monotonic():
+                    hedge_at = Realizer.rate_limiter.blocked_until
+                    continue
+                Realizer.hedged += 1
+                threading.Thread(target=send, args=(True,), daemon=True).start()
+                (sent, running) = (sent + 1, running + 1)
+                continue
+            running -= 1
+            if e is None:
+                Realizer.hedge_wins += hedge
+                return response
+            error = e
+        raise error
+
+    # end is the monotonic deadline, no token is taken and no retry is made after it
+    @staticmethod
+    def _post_geneea(json_file: dict, end: float = None):
+        url = Realizer.url
         headers = {
             'content-type': 'application/json',
             'Authorization': os.getenv('GENJA_API_KEY')
         }
-        return requests.post(url, json=json_file, headers=headers).json()
+
+        for attempt in range(Realizer.max_retries + 1):
+            last_attempt = attempt == Realizer.max_retries
+            if not Realizer.rate_limiter.acquire(end):
+                raise TimeoutError("Realization deadline exceeded")
+            timeout = Realizer.timeout if end is None else min(Realizer.timeout, end - time.monotonic())
+            # requests rejects a zero timeout
+            if timeout <= 0:
+                raise TimeoutError("Realization deadline exceeded")
+            try:
+                response = requests.post(url, json=json_file, headers=headers, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                Realizer._sleep_backoff(attempt, end)
+                continue
+
+            retry_after = None
+            if response.status_code in Realizer.THROTTLE_STATUS:
+                retry_after = Realizer._get_retry_after(response)
+                Realizer.rate_limiter.on_throttle(retry_after)
+
+            if response.status_code in Realizer.RETRY_STATUS and not last_attempt:
+                # with Retry-After the rate limiter itself waits before the next request
+                if retry_after is None:
+                    Realizer._sleep_backoff(attempt, end)
+                continue
+
+            response.raise_for_status()
+            Realizer.rate_limiter.on_success()
+            return response.json()
+
+    @staticmethod
+    def policy_stats() -> str:
+        return f"Realization policy -- deadline: {Realizer.deadline}s, " \
+            f"hedge delay: {Realizer.get_hedge_delay():.3f}s, hedged: {Realizer.hedged}, " \
+            f"hedge wins: {Realizer.hedge_wins}, degraded: {Realizer.degraded}"
+
+    @staticmethod
+    def _sleep_backoff(attempt: int, end: float = None):
+        backoff = Realizer._backoff(attempt)
+        if end is not None and time.monotonic() + backoff >= end:
+            raise TimeoutError("Realization deadline exceeded")
+        time.sleep(backoff)
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # exponential backoff with full jitter
+        return Realizer._jitter.uniform(0, min(Realizer.backoff_max, Realizer.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _get_retry_after(response) -> float:
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Packed match corpus
+#   file layout: magic | index offset | zlib compressed JSON records | JSON index {match id: [offset, length]}
+
+class MatchCorpusWriter:
+    MAGIC = b'SPMC'
+    HEADER = struct.Struct('<4sQ')
+
+    def __init__(self, file_path: str):
+        self._file = open(file_path, 'wb')
+        self._file.write(MatchCorpusWriter.HEADER.pack(MatchCorpusWriter.MAGIC, 0))
+        self._index: Dict[str, List[int]] = {}
+
+    def add(self, match_id: str, raw_json: bytes):
+        data = zlib.compress(raw_json)
+        self._index[match_id] = [self._file.tell(), len(data)]
+        self._file.write(data)
+
+    def close(self):
+        index_offset = self._file.tell()
+        self._file.write(json.dumps(self._index).encode('utf-8'))
+        self._file.seek(0)
+        self._file.write(MatchCorpusWriter.HEADER.pack(MatchCorpusWriter.MAGIC, index_offset))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MatchCorpus:
+    index: Dict[str, List[int]]
+
+    def __init__(self, file_path: str):
+        self._file = open(file_path, 'rb')
+        (magic, index_offset) = MatchCorpusWriter.HEADER.unpack(self._file.read(MatchCorpusWriter.HEADER.size))
+        if magic != MatchCorpusWriter.MAGIC:
+            self._file.close()
+            raise ValueError(f"{file_path} is not a packed match corpus")
+        self._file.seek(index_offset)
+        self.index = json.loads(self._file.read())
+
+    @staticmethod
+    def open(file_path: str):
+        return MatchCorpus(file_path)
+
+    def get(self, match_id: str) -> dict:
+        (offset, length) = self.index[match_id]
+        self._file.seek(offset)
+        return json.loads(zlib.decompress(self._file.read(length)))
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        # sequential read in file order
+        for match_id, _ in sorted(self.index.items(), key=lambda item: item[1][0]):
+            yield match_id, self.get(match_id)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# feeds of the directory (gzipped and in archives included) are stored re-encoded
+def pack_directory(directory: str, corpus_path: str):
+    with MatchCorpusWriter(corpus_path) as writer:
+        for name, json_match_data in iter_match_feeds(directory):
+            if not isinstance(json_match_data, dict):
+                print(f"Skipping invalid match data {name}")
+                continue
+            raw_json = json.dumps(json_match_data, ensure_ascii=False).encode('utf-8')
+            writer.add(get_feed_id(name, json_match_data), raw_json)
+
+
+# scraped rounds come as archives, their members are decompressed into memory one by one
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar', '.zip', '.jsonl', '.jsonl.gz')
+
+
+def is_feed_archive(path: str) -> bool:
+    return path.endswith(ARCHIVE_SUFFIXES)
+
+
+def is_feed_file(path: str) -> bool:
+    return os.path.isfile(path) and path.endswith(('.json', '.json.gz'))
+
+
+# single JSON file, possibly gzipped
+def load_feed(path: str) -> dict:
+    with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path)) as json_file:
+        return json.load(json_file)
+
+
+def iter_archive_feeds(path: str) -> Iterator[Tuple[str, dict]]:
+    def parse(member_name: str, member_file) -> Tuple[str, dict]:
+        try:
+            return f'{path}/{member_name}', json.load(member_file)
+        except ValueError:
+            return f'{path}/{member_name}', None
+
+    try:
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.endswith('.json'):
+                        with archive.open(info) as member_file:
+                            yield parse(info.filename, member_file)
+        elif path.endswith(('.jsonl', '.jsonl.gz')):
+            # one match per line
+            with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path)) as jsonl_file:
+                for k, line in enumerate(jsonl_file, 1):
+                    if line.strip():
+                        try:
+                            yield f'{path}:{k}', json.loads(line)
+                        except ValueError:
+                            yield f'{path}:{k}', None
+        else:
+            # stream mode, the archive is read once from start to end
+            with tarfile.open(path, 'r|*') as archive:
+                for member in archive:
+                    if member.isfile() and member.name.endswith('.json'):
+                        yield parse(member.name, archive.extractfile(member))
+    except (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile):
+        yield path, None
+
+
+# yields (name, match data JSON) from a directory of JSON files and archives, an archive or a packed corpus,
+# JSON is None when the file can't be parsed
+def iter_match_feeds(source: str) -> Iterator[Tuple[str, dict]]:
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            file = os.path.join(source, filename)
+            if is_feed_archive(file):
+                yield from iter_archive_feeds(file)
+                continue
+            try:
+                yield file, load_feed(file)
+            except (OSError, ValueError):
+                yield file, None
+    elif is_feed_archive(source):
+        yield from iter_archive_feeds(source)
+    else:
+        with MatchCorpus.open(source) as corpus:
+            yield from corpus
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Stage artifact cache
+#   artifacts of parsing (MatchData), planning (DocumentPlan) and lexicalization (plain_str) are pickled on disk,
+#   key of a stage = hash of the key of the previous stage + source code of the stage, so a change of e.g. templates
+#   recomputes only lexicalization
+
+class ArtifactCache:
+    current: 'ArtifactCache' = None
+
+    STAGES = ['match_data', 'document_plan', 'plain_str']
+    # classes whose source code is the version of a stage
+    STAGE_CLASSES = {
+        'match_data': ['Score', 'Venue', 'Country', 'Player', 'Team', 'Time', 'Incident', 'Incidents', 'MatchData',
+                       'MatchTimeline', 'DataInitializer', 'DataValidator'],
+        'document_plan': ['Message', 'Messages', 'ContentBudget', 'SelectionEntry', 'DocumentPlan', 'DocumentPlanner',
+                          'Aggregator'],
+        'plain_str': ['MorphParams', 'PlayerForms', 'MentionTracker', 'Template', 'Sentence', 'Lexicalizer'],
+    }
+    _versions: Dict[str, str] = None
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits: Dict[str, int] = {stage: 0 for stage in ArtifactCache.STAGES}
+        self.misses: Dict[str, int] = {stage: 0 for stage in ArtifactCache.STAGES}
+        self._lock = threading.Lock()
+        for stage in ArtifactCache.STAGES:
+            os.makedirs(os.path.join(directory, stage), exist_ok=True)
+        self._size = sum(os.path.getsize(f) for f in self._files())
+
+    # versions are computed here, before any batch worker asks for keys
+    @staticmethod
+    def configure(directory: str, max_bytes: int):
+        ArtifactCache.current = ArtifactCache(directory, max_bytes) if directory is not None else None
+        if ArtifactCache.current is not None and ArtifactCache._versions is None:
+            ArtifactCache._versions = ArtifactCache.compute_stage_versions()
+
+    @staticmethod
+    def get_stage_versions() -> Dict[str, str]:
+        if ArtifactCache._versions is None:
+            ArtifactCache._versions = ArtifactCache.compute_stage_versions()
+        return ArtifactCache._versions
+
+    # one parse of the module source, source of every top-level class is sliced by its lines
+    @staticmethod
+    def compute_stage_versions() -> Dict[str, str]:
+        lines = inspect.getsource(sys.modules[__name__]).splitlines(keepends=True)
+        classes: Dict[str, str] = {}
+        for node in ast.parse(''.join(lines)).body:
+            if isinstance(node, ast.ClassDef):
+                start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                classes[node.name] = ''.join(lines[start - 1:node.end_lineno])
+        return {stage: ArtifactCache._hash(*(classes[name] for name in names))
+                for stage, names in ArtifactCache.STAGE_CLASSES.items()}
+
+    @staticmethod
+    def get_keys(json_match_data: dict, budget: ContentBudget, variants: int = 1) -> Dict[str, str]:
+        versions = ArtifactCache.get_stage_versions()
+        content_hash = ArtifactCache._hash(json.dumps(json_match_data, sort_keys=True))
+
+        keys: Dict[str, str] = {'match_data': ArtifactCache._hash(content_hash, versions['match_data'])}
+        keys['document_plan'] = ArtifactCache._hash(keys['match_data'], versions['document_plan'], str(budget))
+        keys['plain_str'] = ArtifactCache._hash(keys['document_plan'], versions['plain_str'], str(variants))
+        return keys
+
+    @staticmethod
+    def _hash(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, stage: str, key: str) -> str:
+        return os.path.join(self.directory, stage, key + '.pkl')
+
+    def _files(self) -> List[str]:
+        return [os.path.join(self.directory, stage, f) for stage in ArtifactCache.STAGES
+                for f in os.listdir(os.path.join(self.directory, stage)) if f.endswith('.pkl')]
+
+    def get(self, stage: str, key: str):
+        path = self._path(stage, key)
+        try:
+            with open(path, 'rb') as artifact_file:
+                artifact = pickle.load(artifact_file)
+            os.utime(path)  # least recently used are evicted first
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            self.misses[stage] += 1
+            return None
+        self.hits[stage] += 1
+        return artifact
+
+    def put(self, stage: str, key: str, artifact):
+        path = self._path(stage, key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as artifact_file:
+            pickle.dump(artifact, artifact_file)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def get_or_compute(self, stage: str, key: str, compute):
+        artifact = self.get(stage, key)
+        if artifact is None:
+            artifact = compute()
+            self.put(stage, key, artifact)
+        return artifact
+
+    def _evict(self):
+        files = sorted(((os.path.getmtime(f), os.path.getsize(f), f) for f in self._files()))
+        self._size = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if self._size <= self.max_bytes:
+                break
+            os.remove(f)
+            self._size -= size
+
+    def clear(self):
+        for f in self._files():
+            os.remove(f)
+        self._size = 0
+
+    def info(self) -> str:
+        lines = [f"Artifact cache {self.directory} -- size: {self._size / 2 ** 20:.1f} MB "
+                 f"of {self.max_bytes / 2 ** 20:.0f} MB"]
+        for stage in ArtifactCache.STAGES:
+            count = len(os.listdir(os.path.join(self.directory, stage)))
+            lines.append(f"\t{stage}: {count} artifacts, hits: {self.hits[stage]}, misses: {self.misses[stage]}")
+        return "\n".join(lines)
+
+
+def run_stage(stage: str, keys: Dict[str, str], compute):
+    # without keys (e.g. a truncated feed) the stage isn't cached
+    cache = ArtifactCache.current
+    if cache is None or keys is None:
+        return compute()
+    return cache.get_or_compute(stage, keys[stage], compute)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Output sinks
+
+@dataclass(frozen=True)
+class ArticleRecord:
+    match_id: str
+    plain_str: Tuple[str, List[str]]
+    geneea_input: dict
+    article: str
+    timings: Dict[str, float]
+    variant: int
+    # realized locally after the deadline, to be re-realized later
+    degraded: bool
+    # lexicalization decisions, see Lexicalizer.replay
+    trace: List[list]
+
+    @staticmethod
+    def create(match_id: str, plain_str: (str, List[str]), geneea_input: dict, article: str,
+               timings: Dict[str, float], variant: int = 0, degraded: bool = False, trace: List[list] = None):
+        return ArticleRecord(match_id=match_id, plain_str=plain_str, geneea_input=geneea_input, article=article,
+                             timings=timings, variant=variant, degraded=degraded, trace=trace)
+
+    def to_dict(self) -> dict:
+        return {'match_id': self.match_id, 'variant': self.variant,
+                'plain_str': {'title': self.plain_str[0], 'body': self.plain_str[1]},
+                'geneea_input': self.geneea_input, 'article': self.article, 'timings': self.timings,
+                'degraded': self.degraded, 'trace': self.trace}
+
+
+# records are buffered and written in one transaction once the batch is full or the flush interval passed
+class OutputSink:
+    batch_size: int
+    flush_interval: float
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[ArticleRecord] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    def write(self, record: ArticleRecord):
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._buffer:
+                self._write_batch(self._buffer)
+                self._buffer = []
+            self._last_flush = time.monotonic()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def _write_batch(self, records: List[ArticleRecord]):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JsonlSink(OutputSink):
+    def __init__(self, file_path: str, batch_size: int = 500, flush_interval: float = 5.0):
+        super().__init__(batch_size=batch_size, flush_interval=flush_interval)
+        self._file = open(file_path, 'a', encoding='utf-8')
+
+    def _write_batch(self, records: List[ArticleRecord]):
+        self._file.write(''.join(json.dumps(r.to_dict(), ensure_ascii=False) + '\n' for r in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        self._file.close()
+
+
+class SqliteSink(OutputSink):
+    COLUMNS = ('match_id TEXT, variant INTEGER, title TEXT, body TEXT, geneea_input TEXT, article TEXT, '
+               'timings TEXT, degraded INTEGER DEFAULT 0, trace TEXT, PRIMARY KEY (match_id, variant)')
+
+    def __init__(self, file_path: str, batch_size: int = 500, flush_interval: float = 5.0):
+        super().__init__(batch_size=batch_size, flush_interval=flush_interval)
+        # written from batch workers, access is serialized by the sink lock
+        self._connection = sqlite3.connect(file_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(f'CREATE TABLE IF NOT EXISTS articles ({SqliteSink.COLUMNS})')
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(articles)')]
+        if 'variant' not in columns:
+            self._migrate_variants(columns)
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(articles)')]
+        # databases written by older versions lack the later columns
+        for (column, definition) in [('degraded', 'INTEGER DEFAULT 0'), ('trace', 'TEXT')]:
+            if column not in columns:
+                self._connection.execute(f'ALTER TABLE articles ADD COLUMN {column} {definition}')
+        self._connection.commit()
+
+    # match_id was the primary key before variants, the table is recreated and its articles become variant 0
+    def _migrate_variants(self, columns: List[str]):
+        copied = ', '.join(columns)
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.execute('ALTER TABLE articles RENAME TO articles_old')
+            self._connection.execute(f'CREATE TABLE articles ({SqliteSink.COLUMNS})')
+            self._connection.execute(f'INSERT INTO articles ({copied}, variant) SELECT {copied}, 0 FROM articles_old')
+            self._connection.execute('DROP TABLE articles_old')
+
+    def _write_batch(self, records: List[ArticleRecord]):
+        rows = [(r.match_id, r.variant, r.plain_str[0], json.dumps(r.plain_str[1], ensure_ascii=False),
+                 json.dumps(r.geneea_input, ensure_ascii=False), r.article, json.dumps(r.timings), int(r.degraded),
+                 json.dumps(r.trace) if r.trace is not None else None)
+                for r in records]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO articles (match_id, variant, title, body, '
+                                         'geneea_input, article, timings, degraded, trace) '
+                                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _close(self):
+        self._connection.close()
+
+
+def open_sinks(args) -> List[OutputSink]:
+    sinks: List[OutputSink] = []
+    if args.output_jsonl is not None:
+        sinks.append(JsonlSink(args.output_jsonl, batch_size=args.sink_batch_size,
+                               flush_interval=args.sink_flush_interval))
+    if args.output_sqlite is not None:
+        sinks.append(SqliteSink(args.output_sqlite, batch_size=args.sink_batch_size,
+                                flush_interval=args.sink_flush_interval))
+    return sinks
+
+
+# degraded articles get the remote realization they missed, meant to run in the background
+def rerealize_degraded(sqlite_path: str):
+    connection = sqlite3.connect(sqlite_path)
+    rows = connection.execute('SELECT match_id, variant, geneea_input FROM articles WHERE degraded = 1').fetchall()
+    realized = 0
+    for (match_id, variant, geneea_input) in rows:
+        try:
+            article = Realizer.realize_geneea_input(json.loads(geneea_input))
+        except Exception as e:
+            print(f"Re-realizing {match_id} (variant {variant}) failed: {e}")
+            continue
+        with connection:
+            connection.execute('UPDATE articles SET article = ?, degraded = 0 WHERE match_id = ? AND variant = ?',
+                               (article, match_id, variant))
+        realized += 1
+    print(f"Re-realized {realized} of {len(rows)} degraded articles")
+    connection.close()
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Columnar incident store
+#   file layout: magic | header length | JSON header with column directory | 8-byte aligned fixed-width columns
+#   names are kept in a string table (offsets + UTF-8 blob), other columns reference it by index
+
+class IncidentStoreWriter:
+    MAGIC = b'SPIS'
+    VERSION = 1
+    NONE = -1
+
+    # column name -> array typecode
+    COLUMNS = {
+        'match_id': 'i', 'match_team_home': 'i', 'match_team_away': 'i',
+        'match_goals_home': 'h', 'match_goals_away': 'h', 'match_first_incident': 'i', 'match_incident_count': 'i',
+        'inc_match': 'i', 'inc_type': 'b', 'inc_subtype': 'b', 'inc_time_base': 'h', 'inc_time_added': 'h',
+        'inc_team': 'b', 'inc_player_id': 'q', 'inc_player_name': 'i', 'inc_other_id': 'q', 'inc_other_name': 'i',
+        'inc_score_home': 'h', 'inc_score_away': 'h',
+        'string_offsets': 'q', 'string_blob': 'B'
+    }
+
+    def __init__(self):
+        self.columns: Dict[str, array.array] = {name: array.array(typecode)
+                                                for name, typecode in IncidentStoreWriter.COLUMNS.items()}
+        self.columns['string_offsets'].append(0)
+        self._strings: Dict[str, int] = {}
+
+    def add_match(self, match_data: MatchData):
+        c = self.columns
+        c['match_id'].append(self._string(match_data.match_id))
+        c['match_team_home'].append(self._string(match_data.team_home.name))
+        c['match_team_away'].append(self._string(match_data.team_away.name))
+        c['match_goals_home'].append(match_data.score.goals_home)
+        c['match_goals_away'].append(match_data.score.goals_away)
+        c['match_first_incident'].append(len(c['inc_match']))
+        c['match_incident_count'].append(len(match_data.incidents))
+
+        match_idx = len(c['match_id']) - 1
+        for inc in match_data.incidents:
+            self._add_incident(match_idx, inc)
+
+    def _add_incident(self, match_idx: int, inc: Incident):
+        c = self.columns
+        subtype, other, score = IncidentStoreWriter.NONE, None, None
+        if type(inc) is Incidents.Goal:
+            subtype, other, score = inc.goal_type.value, inc.assistance, inc.current_score
+        elif type(inc) is Incidents.Penalty:
+            subtype, score = int(inc.scored), inc.current_score
+        elif type(inc) is Incidents.Card:
+            subtype = inc.card_type.value
+        elif type(inc) is Incidents.Substitution:
+            other = inc.participant_in
+
+        c['inc_match'].append(match_idx)
+        c['inc_type'].append(inc.type.value)
+        c['inc_subtype'].append(subtype)
+        c['inc_time_base'].append(inc.time.base)
+        c['inc_time_added'].append(inc.time.added)
+        c['inc_team'].append(inc.team.type.value)
+        c['inc_player_id'].append(inc.participant.id if inc.participant is not None else IncidentStoreWriter.NONE)
+        c['inc_player_name'].append(self._string(inc.participant.full_name if inc.participant is not None else None))
+        c['inc_other_id'].append(other.id if other is not None else IncidentStoreWriter.NONE)
+        c['inc_other_name'].append(self._string(other.full_name if other is not None else None))
+        c['inc_score_home'].append(score.goals_home if score is not None else IncidentStoreWriter.NONE)
+        c['inc_score_away'].append(score.goals_away if score is not None else IncidentStoreWriter.NONE)
+
+    def _string(self, string: str) -> int:
+        if string is None:
+            return IncidentStoreWriter.NONE
+        if string not in self._strings:
+            self._strings[string] = len(self._strings)
+            self.columns['string_blob'].frombytes(string.encode('utf-8'))
+            self.columns['string_offsets'].append(len(self.columns['string_blob']))
+        return self._strings[string]
+
+    def write(self, file_path: str):
+        directory: Dict[str, list] = {}
+        offset = 0
+        for name, column in self.columns.items():
+            directory[name] = [column.typecode, offset, len(column)]
+            offset += IncidentStoreWriter._aligned(len(column) * column.itemsize)
+
+        header = json.dumps({'version': IncidentStoreWriter.VERSION, 'byteorder': sys.byteorder,
+                             'columns': directory}).encode('utf-8')
+        header_len = IncidentStoreWriter._aligned(len(IncidentStoreWriter.MAGIC) + 4 + len(header))
+        header = header.ljust(header_len - len(IncidentStoreWriter.MAGIC) - 4)
+
+        with open(file_path, 'wb') as store_file:
+            store_file.write(IncidentStoreWriter.MAGIC + struct.pack('<I', header_len) + header)
+            for column in self.columns.values():
+                data = column.tobytes()
+                store_file.write(data + bytes(IncidentStoreWriter._aligned(len(data)) - len(data)))
+
+    @staticmethod
+    def _aligned(size: int) -> int:
+        return (size + 7) // 8 * 8
+
+
+# read only view of the store, columns are zero-copy memoryviews over the mapped file
+class IncidentStore:
+    def __init__(self, file_path: str):
+        self._file = open(file_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views: Dict[str, memoryview] = {}
+        self._match_index: Dict[str, int] = None
+
+        magic_len = len(IncidentStoreWriter.MAGIC)
+        if self._mmap[:magic_len] != IncidentStoreWriter.MAGIC:
+            self.close()
+            raise ValueError(f"{file_path} is not an incident store")
+        (header_len,) = struct.unpack('<I', self._mmap[magic_len:magic_len + 4])
+        header = json.loads(bytes(self._mmap[magic_len + 4:header_len]))
+        if header['version'] != IncidentStoreWriter.VERSION or header['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError(f"Incompatible incident store {file_path}")
+
+        self._data_offset = header_len
+        self._directory: Dict[str, list] = header['columns']
+
+    @staticmethod
+    def open(file_path: str):
+        return IncidentStore(file_path)
+
+    def column(self, name: str) -> memoryview:
+        if name not in self._views:
+            (typecode, offset, length) = self._directory[name]
+            start = self._data_offset + offset
+            size = length * array.array(typecode).itemsize
+            self._views[name] = memoryview(self._mmap)[start:start + size].cast(typecode)
+        return self._views[name]
+
+    def string(self, idx: int) -> str:
+        if idx == IncidentStoreWriter.NONE:
+            return None
+        offsets = self.column('string_offsets')
+        return bytes(self.column('string_blob')[offsets[idx]:offsets[idx + 1]]).decode('utf-8')
+
+    def match_count(self) -> int:
+        return self._directory['match_id'][2]
+
+    def find_match(self, match_id: str) -> int:
+        if self._match_index is None:
+            self._match_index = {self.string(idx): i for i, idx in enumerate(self.column('match_id'))}
+        return self._match_index[match_id]
+
+    def incident_range(self, match_idx: int) -> range:
+        first = self.column('match_first_incident')[match_idx]
+        return range(first, first + self.column('match_incident_count')[match_idx])
+
+    def close(self):
+        for view in self._views.values():
+            view.release()
+        self._views = {}
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def export_store(source: str, store_path: str):
+    writer = IncidentStoreWriter()
+    for name, json_match_data in iter_match_feeds(source):
+        if json_match_data is None or not DataValidator.is_valid(json_match_data):
+            print(f"Skipping invalid match data {name}")
+            continue
+        writer.add_match(DataInitializer.init_match_data_from_json(json_match_data, validate=False))
+    writer.write(store_path)
 
 
 # --------------------------------------------------------------------------------------------------------------------
 # TESTING ALL INPUTS
-def test_inputs(directory: str):
-    files_to_fix = get_files_to_fix(directory)
+def test_inputs(source: str, quarantine_dir: str = None):
+    files_to_fix = get_files_to_fix(source, quarantine_dir)
     if len(files_to_fix) > 50:
         print(f"Nefunguje toho hodně {len(files_to_fix)}")
         print(files_to_fix[0])
@@ -1129,31 +3317,86 @@ def test_inputs(directory: str):
         print(files_to_fix)
 
 
-def get_files_to_fix(directory: str) -> List[str]:
+def get_files_to_fix(source: str, quarantine_dir: str = None) -> List[str]:
     files_to_fix = []
-    for filename in os.listdir(directory):
-        file = os.path.join(directory, filename)
+    for file, json_match_data in iter_match_feeds(source):
+        # invalid feeds are rejected before any parsing
+        if json_match_data is None or not DataValidator.is_valid(json_match_data):
+            files_to_fix.append(file)
+            # only parsed feed files are moved, unparsable files and members of an archive stay where they are
+            if quarantine_dir is not None and json_match_data is not None and is_feed_file(file):
+                quarantine_file(file, quarantine_dir)
+            continue
+
         try:
-            generate_article(file, print_output=False)
+            if DataValidator.validate_match_data(DataInitializer.init_match_data_from_json(json_match_data,
+                                                                                           validate=False)):
+                files_to_fix.append(file)
+                continue
+            generate_article_from_json(json_match_data, file, print_output=False, validate=False)
         except:
             files_to_fix.append(file)
     return files_to_fix
 
 
+def quarantine_file(filename: str, quarantine_dir: str):
+    os.makedirs(quarantine_dir, exist_ok=True)
+    os.replace(filename, os.path.join(quarantine_dir, os.path.basename(filename)))
+
+
 def get_directory(filename:str) -> str:
     return os.path.dirname(filename)
 
 
 # --------------------------------------------------------------------------------------------------------------------
 # GENERATE ARTICLE FROM JSON
-def generate_article(filename: str, print_output: bool):
-    match_data: MatchData = DataInitializer.init_match_data(filename)
+def generate_article(filename: str, print_output: bool, validate: bool = True,
+                     sinks: List[OutputSink] = ()) -> ArticleRecord:
+    json_match_data = load_feed(filename)
+
+    return generate_article_from_json(json_match_data, filename, print_output, validate=validate, sinks=sinks)
+
+
+def get_stage_keys(json_match_data: dict, variants: int = 1) -> Dict[str, str]:
+    if ArtifactCache.current is None:
+        return None
+    return ArtifactCache.get_keys(json_match_data, DocumentPlanner.budget, variants)
+
+
+def plan_match(json_match_data: dict, validate: bool, timings: Dict[str, float],
+               keys: Dict[str, str] = None) -> (MatchData, DocumentPlan):
+    start = time.perf_counter()
+    match_data: MatchData = run_stage('match_data', keys, lambda: DataInitializer.init_match_data_from_json(
+        json_match_data, validate=validate))
+    timings['init'] = time.perf_counter() - start
     # print(f'{match_data} \n\n ' + '_' * 70)
 
-    doc_plan: DocumentPlan = DocumentPlanner.plan_document(match_data)
+    start = time.perf_counter()
+    doc_plan: DocumentPlan = run_stage('document_plan', keys, lambda: Aggregator.aggregate(
+        DocumentPlanner.plan_document(match_data)))
+    timings['plan'] = time.perf_counter() - start
     # print(f'{doc_plan} \n\n ' + '_' * 70)
+    if DocumentPlanner.explain:
+        print(f'{doc_plan.explain_selection()} \n\n ' + '_' * 70)
+
+    return match_data, doc_plan
+
 
-    plain_str: (str, List[str]) = Lexicalizer.lexicalize(doc_plan, match_data)
+def get_match_id(match_data: MatchData, name: str) -> str:
+    return match_data.match_id or os.path.splitext(os.path.basename(name))[0]
+
+
+def generate_article_from_json(json_match_data: dict, name: str, print_output: bool, validate: bool = True,
+                               sinks: List[OutputSink] = ()) -> ArticleRecord:
+    timings: Dict[str, float] = {}
+    keys = get_stage_keys(json_match_data)
+    (match_data, doc_plan) = plan_match(json_match_data, validate, timings, keys)
+
+    start = time.perf_counter()
+    trace: List[list] = []
+    (plain_str, trace) = run_stage('plain_str', keys, lambda: (Lexicalizer.lexicalize(doc_plan, match_data,
+                                                                                      trace=trace), trace))
+    timings['lexicalize'] = time.perf_counter() - start
     print(f'{plain_str} \n\n ' + '_' * 70)
 
     text: str = Realizer.realize_str(plain_str)
@@ -1165,17 +3408,631 @@ def generate_article(filename: str, print_output: bool):
         print(f'{text} \n\n ' + '_' * 70)
 
     # calling Geneea rest API
-    article = Realizer.realize_article(plain_str)
+    start = time.perf_counter()
+    ([article], degraded) = Realizer.realize_within_deadline([plain_str])
+    timings['realize'] = time.perf_counter() - start
+    print(article)
+
+    record = ArticleRecord.create(match_id=get_match_id(match_data, name), plain_str=plain_str,
+                                  geneea_input=Realizer.create_geneea_input(plain_str), article=article,
+                                  timings=timings, degraded=degraded, trace=trace)
+    for sink in sinks:
+        sink.write(record)
+    return record
+
+
+# parsing and planning is done once, only lexicalization and realization per variant
+def generate_variants_from_json(json_match_data: dict, name: str, variants: int, validate: bool = True,
+                                sinks: List[OutputSink] = ()) -> List[ArticleRecord]:
+    timings: Dict[str, float] = {}
+    keys = get_stage_keys(json_match_data, variants)
+    (match_data, doc_plan) = plan_match(json_match_data, validate, timings, keys)
+
+    start = time.perf_counter()
+    traces: List[List[list]] = []
+    (plain_strs, traces) = run_stage('plain_str', keys, lambda: (Lexicalizer.lexicalize_variants(
+        doc_plan, match_data, variants, traces), traces))
+    timings['lexicalize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    (articles, degraded) = Realizer.realize_within_deadline(plain_strs)
+    timings['realize'] = time.perf_counter() - start
+
+    records: List[ArticleRecord] = []
+    for k, (plain_str, article, trace) in enumerate(zip(plain_strs, articles, traces)):
+        print(f'VARIANT {k}\n{article}\n')
+        records.append(ArticleRecord.create(match_id=get_match_id(match_data, name), plain_str=plain_str,
+                                            geneea_input=Realizer.create_geneea_input(plain_str), article=article,
+                                            timings=timings, variant=k, degraded=degraded, trace=trace))
+    for sink in sinks:
+        for record in records:
+            sink.write(record)
+    return records
+
+
+# corrected match data realized with the wording recorded in the trace, without planning or random choice
+def replay_from_json(json_match_data: dict, name: str, trace: List[list], variant: int = 0, validate: bool = True,
+                     sinks: List[OutputSink] = ()) -> ArticleRecord:
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    match_data: MatchData = DataInitializer.init_match_data_from_json(json_match_data, validate=validate)
+    timings['init'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plain_str = Lexicalizer.replay(trace, match_data)
+    timings['replay'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ([article], degraded) = Realizer.realize_within_deadline([plain_str])
+    timings['realize'] = time.perf_counter() - start
+    print(article)
+
+    record = ArticleRecord.create(match_id=get_match_id(match_data, name), plain_str=plain_str,
+                                  geneea_input=Realizer.create_geneea_input(plain_str), article=article,
+                                  timings=timings, variant=variant, degraded=degraded, trace=trace)
+    for sink in sinks:
+        sink.write(record)
+    return record
+
+
+def load_traces(sqlite_path: str, match_id: str) -> List[Tuple[int, List[list]]]:
+    connection = sqlite3.connect(sqlite_path)
+    rows = connection.execute('SELECT variant, trace FROM articles WHERE match_id = ? AND trace IS NOT NULL '
+                              'ORDER BY variant', (match_id,)).fetchall()
+    connection.close()
+    return [(variant, json.loads(trace)) for (variant, trace) in rows]
+
+
+# all digests of a round are planned together and realized in one request
+def generate_round_digests(source: str, sinks: List[OutputSink] = ()) -> List[ArticleRecord]:
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    match_data: List[MatchData] = []
+    for name, json_match_data in iter_match_feeds(source):
+        if json_match_data is None or not DataValidator.is_valid(json_match_data):
+            print(f"Skipping invalid match data {name}")
+            continue
+        match_data.append(DataInitializer.init_match_data_from_json(json_match_data, validate=False))
+    timings['init'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    round_plans = RoundPlanner.plan_rounds(match_data)
+    timings['plan'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plain_strs = [Lexicalizer.lexicalize_round(round_plan, match_data) for round_plan in round_plans]
+    timings['lexicalize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    (articles, degraded) = Realizer.realize_within_deadline(plain_strs) if plain_strs else ([], False)
+    timings['realize'] = time.perf_counter() - start
+
+    records: List[ArticleRecord] = []
+    for round_plan, plain_str, article in zip(round_plans, plain_strs, articles):
+        print(f'{article}\n')
+        records.append(ArticleRecord.create(match_id=f'round:{round_plan.tournament_name}', plain_str=plain_str,
+                                            geneea_input=Realizer.create_geneea_input(plain_str), article=article,
+                                            timings=timings, degraded=degraded))
+    for sink in sinks:
+        for record in records:
+            sink.write(record)
+    return records
+
+
+def generate_from_json(json_match_data: dict, name: str, variants: int, validate: bool = True,
+                       sinks: List[OutputSink] = ()) -> List[ArticleRecord]:
+    if variants > 1:
+        return generate_variants_from_json(json_match_data, name, variants, validate=validate, sinks=sinks)
+    else:
+        return [generate_article_from_json(json_match_data, name, print_output=False, validate=validate,
+                                           sinks=sinks)]
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Speculative generation
+#   - late in the match the body known so far and titles of the plausible final scores are realized in advance
+#   - at full time only sentences of late incidents (and an unexpected title) are sent to the realizer
+
+class Speculation:
+    START_MINUTE = 80
+    # final scores with up to this many late goals get a pre-realized title
+    MAX_LATE_GOALS = 2
+
+    def __init__(self, json_match_data: dict):
+        # live feed isn't complete, so it isn't validated nor cached
+        (match_data, doc_plan) = plan_match(json_match_data, validate=False, timings={}, keys=None)
+
+        # body sentences keep the mention tracker and random stream, late sentences continue from them
+        self.keys: List[str] = [Speculation._get_key(msg) for msg in doc_plan.body]
+        self.tracker = MentionTracker(match_data)
+        self.rng = random.Random(Lexicalizer.SEED)
+        self.body: List[str] = [Lexicalizer._lexicalize_message(msg, self.tracker, self.rng) for msg in doc_plan.body]
+
+        current = match_data.timeline.final_score()
+        self.titles: Dict[Tuple[int, int], str] = {}
+        for home in range(Speculation.MAX_LATE_GOALS + 1):
+            for away in range(Speculation.MAX_LATE_GOALS + 1 - home):
+                score = (current.goals_home + home, current.goals_away + away)
+                self.titles[score] = Speculation._lexicalize_title(match_data, score)
+
+        realized = Realizer.realize_segments(self.body + list(self.titles.values()))
+        self.realized_body: List[str] = realized[:len(self.body)]
+        self.realized_titles: Dict[Tuple[int, int], str] = dict(zip(self.titles, realized[len(self.body):]))
+
+    @staticmethod
+    def _get_key(msg: Messages) -> str:
+        return repr(msg)
+
+    @staticmethod
+    def _lexicalize_title(match_data: MatchData, score: Tuple[int, int]) -> str:
+        title = Messages.Result.create(match_data.team_home, match_data.team_away, Score.create(*score))
+        return Lexicalizer._lexicalize_message(title, MentionTracker(match_data), random.Random(Lexicalizer.SEED))
+
+    # None when the final plan doesn't continue the speculated body (e.g. a late second yellow merged an early card)
+    def finalize(self, match_data: MatchData, doc_plan: DocumentPlan) -> Tuple[Tuple[str, List[str]], str]:
+        keys = [Speculation._get_key(msg) for msg in doc_plan.body]
+        if keys[:len(self.keys)] != self.keys:
+            return None
+
+        tracker = deepcopy(self.tracker)
+        rng = random.Random()
+        rng.setstate(self.rng.getstate())
+        late = [Lexicalizer._lexicalize_message(msg, tracker, rng) for msg in doc_plan.body[len(self.keys):]]
+
+        score = (match_data.score.goals_home, match_data.score.goals_away)
+        title = self.titles.get(score)
+        if title is None:
+            title = Speculation._lexicalize_title(match_data, score)
+            realized = Realizer.realize_segments(late + [title])
+            (realized_late, realized_title) = (realized[:-1], realized[-1])
+        else:
+            (realized_late, realized_title) = (Realizer.realize_segments(late), self.realized_titles[score])
+
+        plain_str = (title, self.body + late)
+        article = ' '.join([realized_title] + self.realized_body + realized_late)
+        return plain_str, article
+
+    @staticmethod
+    def truncate_feed(json_match_data: dict, minute: int) -> dict:
+        # feed as it looked at the given minute, auxiliary incidents go with their parent
+        incidents = [i for i in json_match_data['incidents'] if i['time'] < minute]
+        ids = {i['id'] for i in incidents}
+        incidents = [i for i in incidents if i['parentId'] is None or i['parentId'] in ids]
+
+        truncated = dict(json_match_data, incidents=incidents, stage={'id': 2, 'name': 'Live'})
+        current = DataInitializer.init_match_data_from_json(truncated, validate=False).timeline.final_score()
+        score = deepcopy(json_match_data['score'])
+        score[str(Types.Team.HOME.value)]['1'] = current.goals_home
+        score[str(Types.Team.AWAY.value)]['1'] = current.goals_away
+        return dict(truncated, score=score)
+
+
+def generate_speculative_from_json(json_match_data: dict, name: str, minute: int, validate: bool = True,
+                                   sinks: List[OutputSink] = ()) -> ArticleRecord:
+    timings: Dict[str, float] = {}
+
+    start = time.perf_counter()
+    try:
+        speculation = Speculation(Speculation.truncate_feed(json_match_data, minute))
+    except TimeoutError:
+        speculation = None
+    timings['speculate'] = time.perf_counter() - start
+
+    # final whistle
+    start = time.perf_counter()
+    (match_data, doc_plan) = plan_match(json_match_data, validate, timings, get_stage_keys(json_match_data))
+    result = None
+    if speculation is not None:
+        try:
+            result = speculation.finalize(match_data, doc_plan)
+        except TimeoutError:
+            pass
+    if result is None:
+        print(f"Speculation for {name} missed, generating the whole article")
+        return generate_article_from_json(json_match_data, name, print_output=False, validate=False, sinks=sinks)
+    (plain_str, article) = result
+    timings['finalize'] = time.perf_counter() - start
     print(article)
+    print(f"Speculated at minute {minute} in {timings['speculate']:.3f}s, "
+          f"finalized after the final whistle in {timings['finalize']:.3f}s")
+
+    record = ArticleRecord.create(match_id=get_match_id(match_data, name), plain_str=plain_str,
+                                  geneea_input=Realizer.create_geneea_input(plain_str), article=article,
+                                  timings=timings)
+    for sink in sinks:
+        sink.write(record)
+    return record
+
+
+# whole round planned first, then lexicalized in one batch
+def lexicalize_round(source: str, seed: int = None) -> List[Tuple[str, Tuple[str, List[str]]]]:
+    names: List[str] = []
+    plans: List[Tuple[MatchData, DocumentPlan]] = []
+    for name, json_match_data in iter_match_feeds(source):
+        if json_match_data is None or not DataValidator.is_valid(json_match_data):
+            print(f"Skipping invalid match data {name}")
+            continue
+        # data errors skip the match, programming errors stop the round
+        try:
+            plans.append(plan_match(json_match_data, validate=False, timings={},
+                                    keys=get_stage_keys(json_match_data)))
+        except ValueError as e:
+            print(f"Planning article from {name} failed: {e}")
+            continue
+        names.append(name)
+
+    start = time.perf_counter()
+    plain_strs = Lexicalizer.lexicalize_batch([doc_plan for (_, doc_plan) in plans],
+                                              [match_data for (match_data, _) in plans], seed)
+    print(f"Lexicalized {len(plain_strs)} matches in {time.perf_counter() - start:.3f}s "
+          f"({'numpy' if numpy is not None else 'random'} draws)")
+    return list(zip(names, plain_strs))
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# Job scheduling
+
+@dataclass(frozen=True)
+class Job:
+    name: str
+    json_match_data: dict
+    priority: Types.Priority
+    deadline: float
+    enqueued: float
+
+    @staticmethod
+    def create(name: str, json_match_data: dict, priority: Types.Priority, deadline: float):
+        return Job(name=name, json_match_data=json_match_data, priority=priority, deadline=deadline,
+                   enqueued=time.time())
+
+
+# jobs are served by priority class, earliest deadline first within a class
+#   - a lower class not served for STARVATION_LIMIT seconds gets the next free worker
+class JobScheduler:
+    # seconds from the end of the match (other classes: from enqueueing) in which the article should be published
+    SLA = {Types.Priority.LIVE: 30.0, Types.Priority.JUST_FINISHED: 120.0, Types.Priority.BACKLOG: 3600.0}
+    STARVATION_LIMIT = {Types.Priority.JUST_FINISHED: 30.0, Types.Priority.BACKLOG: 60.0}
+    # matches that ended earlier than this are backlog
+    JUST_FINISHED_WINDOW = 6 * 3600.0
+    MATCH_DURATION = 115 * 60.0
+    # queued jobs per worker in batch runs, the producer waits above it so feeds aren't all loaded into memory
+    PENDING_PER_WORKER = 4
+
+    # submit blocks while max_pending jobs are queued, None means unbounded
+    def __init__(self, max_pending: int = None):
+        self.max_pending = max_pending
+        self._queues: Dict[Types.Priority, List[Tuple[float, int, Job]]] = {p: [] for p in Types.Priority}
+        self._last_served: Dict[Types.Priority, float] = {p: time.time() for p in Types.Priority}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._counter = 0
+        self.latencies: Dict[Types.Priority, List[float]] = {p: [] for p in Types.Priority}
+        self.late: Dict[Types.Priority, int] = {p: 0 for p in Types.Priority}
+        self.aged = 0
+
+    @staticmethod
+    def get_match_end(json_match_data: dict) -> float:
+        try:
+            return datetime.fromisoformat(json_match_data['time_start']).timestamp() + JobScheduler.MATCH_DURATION
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def classify(json_match_data: dict, now: float = None) -> Types.Priority:
+        now = time.time() if now is None else now
+        if json_match_data.get('stage', {}).get('name') != 'Finished':
+            return Types.Priority.LIVE
+        match_end = JobScheduler.get_match_end(json_match_data)
+        if match_end is not None and now - match_end <= JobScheduler.JUST_FINISHED_WINDOW:
+            return Types.Priority.JUST_FINISHED
+        return Types.Priority.BACKLOG
+
+    @staticmethod
+    def get_deadline(json_match_data: dict, priority: Types.Priority, now: float = None) -> float:
+        now = time.time() if now is None else now
+        match_end = JobScheduler.get_match_end(json_match_data)
+        # archive matches ended long ago, their deadline runs from enqueueing
+        if priority != Types.Priority.JUST_FINISHED or match_end is None:
+            return now + JobScheduler.SLA[priority]
+        return match_end + JobScheduler.SLA[priority]
+
+    def submit(self, name: str, json_match_data: dict, priority: Types.Priority = None, deadline: float = None):
+        if priority is None:
+            priority = JobScheduler.classify(json_match_data)
+        if deadline is None:
+            deadline = JobScheduler.get_deadline(json_match_data, priority)
+        job = Job.create(name, json_match_data, priority, deadline)
+        with self._condition:
+            while self.max_pending is not None and self.pending >= self.max_pending and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise ValueError("Job submitted to a closed scheduler")
+            heapq.heappush(self._queues[priority], (deadline, self._counter, job))
+            self._counter += 1
+            # producer and workers wait on the same condition
+            self._condition.notify_all()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    # no more jobs will be submitted, workers finish the queued ones and stop
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def next_job(self) -> Job:
+        with self._condition:
+            while not any(self._queues.values()):
+                if self._closed:
+                    return None
+                self._condition.wait()
+
+            now = time.time()
+            priority = self._get_starving(now)
+            if priority is not None:
+                self.aged += 1
+            else:
+                priority = next(p for p in Types.Priority if self._queues[p])
+
+            (_, _, job) = heapq.heappop(self._queues[priority])
+            self._condition.notify_all()
+            self._last_served[priority] = now
+            self.latencies[priority].append(now - job.enqueued)
+            return job
+
+    def _get_starving(self, now: float) -> Types.Priority:
+        for priority in Types.Priority:
+            if priority not in JobScheduler.STARVATION_LIMIT or not self._queues[priority]:
+                continue
+            (_, _, job) = self._queues[priority][0]
+            waiting = now - max(self._last_served[priority], job.enqueued)
+            if waiting > JobScheduler.STARVATION_LIMIT[priority]:
+                return priority
+        return None
+
+    def done(self, job: Job):
+        if time.time() > job.deadline:
+            with self._condition:
+                self.late[job.priority] += 1
+
+    def run(self, process, workers: int) -> List[threading.Thread]:
+        def work():
+            while True:
+                job = self.next_job()
+                if job is None:
+                    return
+                try:
+                    process(job)
+                finally:
+                    self.done(job)
+
+        threads = [threading.Thread(target=work, name=f'worker-{k}', daemon=True) for k in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stats(self) -> str:
+        lines = []
+        for priority in Types.Priority:
+            latencies = sorted(self.latencies[priority])
+            if not latencies:
+                continue
+            p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            lines.append(f"{priority.name.lower()}: {len(latencies)} jobs, queue latency mean "
+                         f"{sum(latencies) / len(latencies):.3f}s, p95 {p95:.3f}s, max {latencies[-1]:.3f}s, "
+                         f"late {self.late[priority]}")
+        return "Scheduler -- " + ("; ".join(lines) or "no jobs") + f"; aged {self.aged}"
+
+
+# --------------------------------------------------------------------------------------------------------------------
+# BATCH GENERATION
+
+# state of every match of a batch run
+#   - journal of JSON lines, the last line of a match wins, a torn last line is ignored
+#   - compacted into one line per match at the end of the run
+class BatchManifest:
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    entries: Dict[str, dict]
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.entries = {}
+        if os.path.exists(file_path):
+            with open(file_path, encoding='utf-8') as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['match_id']] = entry
+        self._file = open(file_path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def is_done(self, match_id: str) -> bool:
+        return self.entries.get(match_id, {}).get('status') == BatchManifest.DONE
+
+    def record(self, match_id: str, status: str, error: str = None, checksum: str = None):
+        self.record_all([{'match_id': match_id, 'status': status, 'error': error, 'checksum': checksum}])
+
+    def record_all(self, entries: List[dict]):
+        if not entries:
+            return
+        with self._lock:
+            # one write per call, so a crash can tear only the last line
+            self._file.write(''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            for e in entries:
+                self.entries[e['match_id']] = e
+
+    def close(self):
+        self._file.close()
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            manifest_file.write(''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in self.entries.values()))
+        os.replace(tmp_path, self.file_path)
+
+    def summary(self) -> str:
+        counts: Dict[str, int] = {}
+        for e in self.entries.values():
+            counts[e['status']] = counts.get(e['status'], 0) + 1
+        return "Manifest -- " + ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+
+    @staticmethod
+    def checksum(records: List[ArticleRecord]) -> str:
+        return hashlib.sha256('\0'.join(r.article for r in records).encode('utf-8')).hexdigest()
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    [index, count] = shard.split('/')
+    if not 0 <= int(index) < int(count):
+        raise ValueError(f"Invalid shard {shard}")
+    return int(index), int(count)
+
+
+def is_in_shard(match_id: str, shard: Tuple[int, int]) -> bool:
+    # stable across machines, unlike hash()
+    return int(hashlib.md5(match_id.encode('utf-8')).hexdigest(), 16) % shard[1] == shard[0]
+
+
+def get_feed_id(name: str, json_match_data: dict) -> str:
+    match_id = DataInitializer._init_match_id(json_match_data) if json_match_data is not None else None
+    return match_id or os.path.splitext(os.path.basename(name))[0]
+
+
+def run_batch(source: str, sinks: List[OutputSink], variants: int = 1, manifest: BatchManifest = None,
+              resume: bool = False, shard: Tuple[int, int] = (0, 1), workers: int = 1):
+    # matches are recorded as done only after all sinks wrote their articles
+    unconfirmed: List[dict] = []
+    unconfirmed_lock = threading.Lock()
+
+    def process(job: Job):
+        nonlocal unconfirmed
+        match_id = get_feed_id(job.name, job.json_match_data)
+        if manifest is not None:
+            manifest.record(match_id, BatchManifest.PENDING)
+        try:
+            records = generate_from_json(job.json_match_data, job.name, variants, validate=False, sinks=sinks)
+        except Exception as e:
+            print(f"Generating article from {job.name} failed: {e}")
+            if manifest is not None:
+                manifest.record(match_id, BatchManifest.FAILED, error=str(e))
+            return
+
+        if manifest is not None:
+            with unconfirmed_lock:
+                unconfirmed.append({'match_id': match_id, 'status': BatchManifest.DONE, 'error': None,
+                                    'checksum': BatchManifest.checksum(records)})
+                if all(sink.pending == 0 for sink in sinks):
+                    manifest.record_all(unconfirmed)
+                    unconfirmed = []
+
+    scheduler = JobScheduler(max_pending=max(1, workers) * JobScheduler.PENDING_PER_WORKER)
+    threads = scheduler.run(process, workers)
+    for name, json_match_data in iter_match_feeds(source):
+        match_id = get_feed_id(name, json_match_data)
+        if not is_in_shard(match_id, shard):
+            continue
+        if resume and manifest is not None and manifest.is_done(match_id):
+            continue
+
+        if json_match_data is None or not DataValidator.is_valid(json_match_data):
+            print(f"Skipping invalid match data {name}")
+            if manifest is not None:
+                manifest.record(match_id, BatchManifest.FAILED, error="invalid match data")
+            continue
+        scheduler.submit(name, json_match_data)
+
+    scheduler.close()
+    for thread in threads:
+        thread.join()
+    print(scheduler.stats())
+
+    for sink in sinks:
+        sink.flush()
+    if manifest is not None:
+        manifest.record_all(unconfirmed)
 
 
 # --------------------------------------------------------------------------------------------------------------------
 # MAIN
 def main(args):
-    if args.test:
-        test_inputs(get_directory(args.match_data))
-    else:
-        generate_article(args.match_data, print_output=False)
+    Realizer.configure(url=args.geneea_url, rate=args.geneea_rate, burst=args.geneea_burst,
+                       max_retries=args.geneea_retries)
+    # re-realization has no deadline
+    Realizer.configure_policy(args.deadline if args.rerealize is None else None, args.hedge_percentile)
+    DocumentPlanner.configure(ContentBudget.create(max_sentences=args.max_sentences, max_chars=args.max_chars),
+                              explain=args.explain_selection)
+    if args.inflection_memo is not None:
+        Realizer.inflection_memo = InflectionMemo(args.inflection_memo)
+    ArtifactCache.configure(args.cache_dir, args.cache_max_mb * 2 ** 20)
+
+    if ArtifactCache.current is not None and (args.cache_info or args.cache_clear):
+        if args.cache_clear:
+            ArtifactCache.current.clear()
+        print(ArtifactCache.current.info())
+        return
+
+    sinks: List[OutputSink] = open_sinks(args)
+    try:
+        if args.rerealize is not None:
+            rerealize_degraded(args.rerealize)
+        elif args.replay is not None:
+            json_match_data = load_feed(args.match_data)
+            match_id = get_feed_id(args.match_data, json_match_data)
+            traces = load_traces(args.replay, match_id)
+            if not traces:
+                raise ValueError(f"No trace of match {match_id} in {args.replay}")
+            for (variant, trace) in traces:
+                replay_from_json(json_match_data, args.match_data, trace, variant, sinks=sinks)
+        elif args.test:
+            test_source = args.match_data if is_feed_archive(args.match_data) else get_directory(args.match_data)
+            test_inputs(test_source, args.quarantine)
+        elif args.pack_corpus is not None:
+            pack_directory(args.pack_corpus, args.corpus)
+        elif args.export_store is not None:
+            export_store(args.batch or get_directory(args.match_data), args.export_store)
+        elif args.batch is not None and args.round_digest:
+            generate_round_digests(args.batch, sinks=sinks)
+        elif args.batch is not None and args.lexicalize_round:
+            for name, plain_str in lexicalize_round(args.batch):
+                print(f'{name}\n{Realizer.realize_str(plain_str)}\n')
+        elif args.batch is not None:
+            manifest = BatchManifest(args.manifest) if args.manifest is not None else None
+            try:
+                run_batch(args.batch, sinks, args.variants, manifest=manifest, resume=args.resume,
+                          shard=parse_shard(args.shard), workers=args.workers)
+            finally:
+                if manifest is not None:
+                    manifest.close()
+                    print(manifest.summary())
+        elif args.corpus is not None:
+            with MatchCorpus.open(args.corpus) as corpus:
+                generate_from_json(corpus.get(args.match_data), args.match_data, args.variants, sinks=sinks)
+        elif args.speculate is not None:
+            generate_speculative_from_json(load_feed(args.match_data), args.match_data, args.speculate, sinks=sinks)
+        elif args.variants > 1:
+            generate_variants_from_json(load_feed(args.match_data), args.match_data, args.variants, sinks=sinks)
+        else:
+            generate_article(args.match_data, print_output=False, sinks=sinks)
+    finally:
+        for sink in sinks:
+            sink.close()
+        if Realizer.inflection_memo is not None:
+            Realizer.inflection_memo.save()
+            print(Realizer.inflection_memo.stats())
+        if ArtifactCache.current is not None:
+            print(ArtifactCache.current.info())
+        if Realizer.coalescer.requests > 0:
+            print(Realizer.coalescer.stats())
+            print(Realizer.rate_limiter.stats())
+        if Realizer.deadline is not None:
+            print(Realizer.policy_stats())
 
 
 if __name__ == "__main__":